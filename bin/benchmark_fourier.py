@@ -0,0 +1,49 @@
+from __future__ import print_function
+import numpy as np
+import time
+import argparse
+from pixell import enmap
+from orphics import maps
+
+# Parse command line
+parser = argparse.ArgumentParser(description='Benchmark FFT throughput of maps.FourierCalc against enmap.fft.')
+parser.add_argument("-n", "--npix",     type=int,  nargs='+', default=[1000,4000],help="Square patch sizes to time")
+parser.add_argument("-r", "--nrep",     type=int,  default=5,help="Transforms per timing")
+parser.add_argument("-t", "--nthread",  type=int,  default=0,help="FFT threads (0 for pixell default)")
+parser.add_argument("-w", "--wisdom",   type=str,  default=None,help="FFTW wisdom file to load and save")
+parser.add_argument("--float32", action='store_true',help='Time single precision maps.')
+parser.add_argument("--measure", action='store_true',help='Plan with FFTW_MEASURE instead of FFTW_ESTIMATE.')
+args = parser.parse_args()
+
+dtype = np.float32 if args.float32 else np.float64
+
+def timeit(func,arr,nrep):
+    func(arr) # first call pays for planning
+    t0 = time.time()
+    for i in range(nrep): func(arr)
+    return (time.time()-t0)/nrep
+
+print("pyfftw available : ", maps.pyfftw is not None)
+for npix in args.npix:
+    shape,wcs = maps.rect_geometry(width_arcmin=npix*0.5,px_res_arcmin=0.5)
+    imap = enmap.enmap(np.random.standard_normal(shape).astype(dtype),wcs)
+    t0 = time.time()
+    fc = maps.FourierCalc(shape,wcs,nthread=args.nthread,wisdom_file=args.wisdom,
+                          flags=('FFTW_MEASURE',) if args.measure else ('FFTW_ESTIMATE',))
+    kmap = fc.fft(imap)
+    rkmap = fc.rfft(imap)
+    fc.ifft(kmap)
+    fc.irfft(rkmap)
+    tplan = time.time()-t0
+    timings = [
+        ("enmap.fft",timeit(lambda x: enmap.fft(x,normalize=False,nthread=args.nthread),imap,args.nrep)),
+        ("enmap.ifft",timeit(lambda x: enmap.ifft(x,normalize=True,nthread=args.nthread),kmap,args.nrep)),
+        ("FourierCalc.fft",timeit(fc.fft,imap,args.nrep)),
+        ("FourierCalc.ifft",timeit(fc.ifft,kmap,args.nrep)),
+        ("FourierCalc.rfft",timeit(fc.rfft,imap,args.nrep)),
+        ("FourierCalc.irfft",timeit(fc.irfft,rkmap,args.nrep)),
+        ]
+    print("==== ", tuple(int(n) for n in shape), " ", np.dtype(dtype).name, " (planning ", "%.2f" % tplan, " s) ====")
+    for name,t in timings:
+        print("%-20s %8.1f ms %8.2f maps/s" % (name,t*1e3,1./t))
+    if args.wisdom is not None: fc.save_wisdom()
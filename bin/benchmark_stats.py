@@ -0,0 +1,83 @@
+from __future__ import print_function
+import numpy as np
+import time
+import argparse
+import subprocess
+import sys
+from orphics import mpi, stats
+
+# Parse command line
+parser = argparse.ArgumentParser(description='Benchmark the MPI reductions of stats.Stats against a root receive loop.')
+parser.add_argument("-n", "--npix",     type=int,  default=2000,help="Stacks are npix x npix")
+parser.add_argument("-l", "--nlabels",  type=int,  default=2,help="Number of stack labels")
+parser.add_argument("-b", "--nbins",    type=int,  default=50,help="Length of the 1d vectors for get_stats")
+parser.add_argument("-s", "--nsims",    type=int,  default=100,help="1d vectors added per rank")
+parser.add_argument("-r", "--ranks",    type=int,  nargs='+', default=None,
+                    help="Launch this script with mpirun for each of these rank counts")
+parser.add_argument("--mpirun",         type=str,  default="mpirun",help="MPI launcher")
+args = parser.parse_args()
+
+if args.ranks is not None:
+    argv = [a for a in sys.argv[1:]]
+    i = argv.index("-r") if "-r" in argv else argv.index("--ranks")
+    j = i+1
+    while j<len(argv) and not(argv[j].startswith("-")): j += 1
+    argv = argv[:i]+argv[j:]
+    for nranks in args.ranks:
+        subprocess.check_call([args.mpirun,"-n",str(nranks),sys.executable,__file__]+argv)
+    sys.exit()
+
+comm = mpi.MPI.COMM_WORLD
+rank = comm.Get_rank()
+numcores = comm.Get_size()
+
+def p2p_stacks(comm,little_stack,little_stack_count,root=0):
+    # Reference: every rank sends its counts and stacks to root, which receives them in rank order
+    stacks = {}
+    if rank!=root:
+        for k,label in enumerate(sorted(little_stack.keys())):
+            comm.send(little_stack_count[label], dest=root, tag=3000+k)
+            comm.Send(little_stack[label], dest=root, tag=10+k)
+        return None
+    for k,label in enumerate(sorted(little_stack.keys())):
+        count = little_stack_count[label]
+        stacks[label] = little_stack[label].copy()
+        for core in range(1,numcores):
+            count += comm.recv(source=core, tag=3000+k)
+            data_vessel = np.empty(stacks[label].shape, dtype=np.float64)
+            comm.Recv(data_vessel, source=core, tag=10+k)
+            stacks[label] += data_vessel
+        stacks[label] /= count
+    return stacks
+
+def timed(func):
+    comm.Barrier()
+    t0 = time.time()
+    ret = func()
+    comm.Barrier()
+    return time.time()-t0,ret
+
+rng = np.random.default_rng(rank)
+st = stats.Stats(comm)
+for k in range(args.nlabels):
+    st.add_to_stack("stack%d" % k,rng.standard_normal((args.npix,args.npix)))
+full = stats.Stats(comm)
+stream = stats.Stats(comm,streaming=True)
+for i in range(args.nsims):
+    vec = rng.standard_normal(args.nbins)
+    full.add_to_stats("vec",vec)
+    stream.add_to_stats("vec",vec)
+
+tref,ref = timed(lambda: p2p_stacks(comm,st.little_stack,st.little_stack_count))
+tcol,_ = timed(lambda: st.get_stacks(verbose=False))
+tfull,_ = timed(lambda: full.get_stats(verbose=False))
+tstream,_ = timed(lambda: stream.get_stats())
+
+if rank==0:
+    for label in ref.keys(): assert np.allclose(ref[label],st.stacks[label])
+    assert np.allclose(full.stats["vec"]["cov"],stream.stats["vec"]["cov"])
+    print("==== ", numcores, " ranks, ", args.nlabels, " stacks of ", args.npix, "x", args.npix, " ====")
+    print("%-28s %8.1f ms" % ("stacks, root receive loop",tref*1e3))
+    print("%-28s %8.1f ms" % ("Stats.get_stacks (Reduce)",tcol*1e3))
+    print("%-28s %8.1f ms" % ("Stats.get_stats, vectors",tfull*1e3))
+    print("%-28s %8.1f ms" % ("Stats.get_stats, streaming",tstream*1e3))
@@ -4,7 +4,7 @@ from enlib import enmap, bench, curvedsky, lensing, powspec, mapsim
 from orphics import cosmology, io, maps
 import numpy as np
 import sys, os,traceback
-from orphics.mpi import MPI,mpi_distribute
+from orphics.mpi import MPI,mpi_distribute,DynamicTasks
 import healpy as hp
 import argparse
 
@@ -19,6 +19,9 @@ parser.add_argument("-s", "--seed",     type=int,  default=None)
 parser.add_argument("-l", "--lmax",     type=int,  default=8000)
 parser.add_argument("-m", "--maplmax",  type=int,  default=None)
 parser.add_argument("--ncomp",          type=int,  default=3)
+parser.add_argument("--checkpoint",     type=str,  default=None,help="Path prefix for per-rank checkpoints; a rerun resumes from them")
+parser.add_argument("--checkpoint-every",type=int, default=1,help="Checkpoint after this many sims")
+parser.add_argument("--dynamic", action='store_true',help='Hand out sims to ranks on demand instead of in fixed blocks.')
 
 #parser.add_argument("-f", "--flag", action='store_true',help='A flag.')
 args = parser.parse_args()
@@ -36,9 +39,12 @@ rank = comm.Get_rank()
 numcores = comm.Get_size()    
 Ntot = Nsims
 num_each,each_tasks = mpi_distribute(Ntot,numcores)
-mpibox = Stats(comm,tag_start=333)
+mpibox = Stats(comm,tag_start=333,checkpoint=args.checkpoint,checkpoint_every=args.checkpoint_every)
 if rank==0: print("At most ", max(num_each) , " tasks...")
-my_tasks = each_tasks[rank]
+if args.dynamic:
+    my_tasks = DynamicTasks(mpibox.resume(range(Ntot)),comm=comm)
+else:
+    my_tasks = mpibox.resume(each_tasks[rank])
 
 
 
@@ -54,10 +60,10 @@ def load(suffix,index):
 
 
 
-for k,index in enumerate(my_tasks):
+def do_task(k,index):
 
 
-    if rank==0: print("Rank 0 doing task ", k, " / ", len(my_tasks), "...")
+    if rank==0: print("Rank 0 doing task ", k, " / ", len(my_tasks.tasks if args.dynamic else my_tasks), "...")
 
     try:
         
@@ -102,8 +108,15 @@ for k,index in enumerate(my_tasks):
     mpibox.add_to_stack("lcls",lcls)
     mpibox.add_to_stack("ucls",ucls)
     mpibox.add_to_stack("kcls",kcls)
+    mpibox.task_done(index)
 
+# Every rank must free the dynamic task counter, even if its loop stops early
+try:
+    for k,index in enumerate(my_tasks): do_task(k,index)
+finally:
+    if args.dynamic: my_tasks.close()
 
+if args.dynamic: my_tasks.report()
 mpibox.get_stacks()
 
 if rank==0:
@@ -121,6 +121,56 @@ def save_cols(filename,tuple_of_vectors,**kwargs):
     save_mat = np.vstack(tuple_of_vectors).T
     np.savetxt(filename,save_mat,**kwargs)
 
+### CACHING
+
+def hash_arrays(*items):
+    """Returns a hex digest that changes whenever any of the items change.
+
+    items can be arrays, scalars, strings or None. Arrays are hashed by
+    dtype, shape and contents.
+    """
+    import hashlib
+    h = hashlib.sha1()
+    for item in items:
+        if item is None:
+            h.update(b'None')
+        elif isinstance(item,str):
+            h.update(item.encode())
+        else:
+            a = np.ascontiguousarray(np.asarray(item))
+            h.update(str(a.dtype).encode())
+            h.update(str(a.shape).encode())
+            h.update(a.tobytes())
+        h.update(b'|')
+    return h.hexdigest()
+
+def save_array_cache(cache_dir,key,arrays):
+    """Save a dict of arrays as .npy files in cache_dir/key.
+
+    The files are written to a temporary directory that is renamed into
+    place, so concurrent readers never see a partial cache. If another
+    process got there first, its copy is kept.
+    """
+    import tempfile,shutil
+    os.makedirs(cache_dir,exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=cache_dir,prefix="."+key)
+    for name,arr in arrays.items():
+        np.save(os.path.join(tmpdir,name+".npy"),np.asarray(arr))
+    try:
+        os.rename(tmpdir,os.path.join(cache_dir,key))
+    except OSError:
+        shutil.rmtree(tmpdir,ignore_errors=True)
+
+def load_array_cache(cache_dir,key,mmap_mode='r'):
+    """Load a dict of arrays saved with save_array_cache.
+
+    Returns None if there is no cache for key. By default the arrays are
+    read-only memory maps, so processes on a node share one copy.
+    """
+    path = os.path.join(cache_dir,key)
+    if not(os.path.isdir(path)): return None
+    return dict([(f[:-4],np.load(os.path.join(path,f),mmap_mode=mmap_mode)) for f in os.listdir(path) if f.endswith(".npy")])
+
 ### NAMING
     
 def join_nums(nums):
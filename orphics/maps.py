@@ -1,15 +1,21 @@
 from __future__ import print_function 
 import contextlib
-from pixell import enmap, utils, resample
+from pixell import enmap, utils, resample, wcsutils
 import numpy as np
 from pixell.fft import fft,ifft
 from scipy.interpolate import interp1d
 import yaml,six
 from orphics import io,cosmology,stats
-import math
+import math, os, time, threading
 from scipy.interpolate import RectBivariateSpline,interp2d,interp1d
 import warnings
 import healpy as hp
+from pixell import fft as enfft
+from six.moves import cPickle as pickle
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
 
 def rms_from_ivar(ivar,parea=None,cylindrical=True):
     """
@@ -350,21 +356,41 @@ class MapGen(object):
         pre-calculate some things to speed up random map generation.
         """
 
-        def __init__(self,shape,wcs,cov=None,covsqrt=None,pixel_units=False,smooth="auto",ndown=None,order=1):
+        def __init__(self,shape,wcs,cov=None,covsqrt=None,pixel_units=False,smooth="auto",ndown=None,order=1,cache_dir=None,comm=None):
+                """
+                cache_dir=None: directory in which to cache covsqrt, keyed by a hash of cov, the
+                geometry and the smoothing settings. Cached covsqrt is read back as a read-only
+                memory map. If an MPI comm is given, only rank 0 computes it on a cache miss.
+                """
                 self.shape = shape
                 self.wcs = wcs
-                assert cov.ndim>=3 , "Power spectra have to be of shape (ncomp,ncomp,lmax) or (ncomp,ncomp,Ny,Nx)."
                 if covsqrt is not None:
                     self.covsqrt = covsqrt
+                    return
+                assert cov.ndim>=3 , "Power spectra have to be of shape (ncomp,ncomp,lmax) or (ncomp,ncomp,Ny,Nx)."
+                if cache_dir is None:
+                    self.covsqrt = self._get_covsqrt(cov,pixel_units,smooth,ndown,order)
+                    return
+                rank = 0 if comm is None else comm.Get_rank()
+                key = io.hash_arrays("MapGen",str(tuple(shape)),wcs.to_header_string(),cov,
+                                     pixel_units,str(smooth),ndown,order)
+                cached = io.load_array_cache(cache_dir,key)
+                if cached is None and rank==0:
+                    io.save_array_cache(cache_dir,key,{'covsqrt':self._get_covsqrt(cov,pixel_units,smooth,ndown,order)})
+                if comm is not None: comm.Barrier()
+                if cached is None: cached = io.load_array_cache(cache_dir,key)
+                self.covsqrt = enmap.ndmap(cached['covsqrt'],wcs)
+
+        def _get_covsqrt(self,cov,pixel_units,smooth,ndown,order):
+                shape,wcs = self.shape,self.wcs
+                if cov.ndim==4:
+                        if not(pixel_units): cov = cov * np.prod(shape[-2:])/enmap.area(shape,wcs )
+                        if ndown:
+                            return downsample_power(shape,wcs,cov,ndown,order,exp=0.5)
+                        else:
+                            return enmap.multi_pow(cov, 0.5)
                 else:
-                    if cov.ndim==4:
-                            if not(pixel_units): cov = cov * np.prod(shape[-2:])/enmap.area(shape,wcs )
-                            if ndown:
-                                self.covsqrt = downsample_power(shape,wcs,cov,ndown,order,exp=0.5)
-                            else:
-                                self.covsqrt = enmap.multi_pow(cov, 0.5)
-                    else:
-                            self.covsqrt = enmap.spec2flat(shape, wcs, cov, 0.5, mode="constant",smooth=smooth)
+                        return enmap.spec2flat(shape, wcs, cov, 0.5, mode="constant",smooth=smooth)
 
 
         def get_map(self,seed=None,scalar=False,iau=True,real=False):
@@ -382,30 +408,171 @@ class MapGen(object):
                 else:
                         return enmap.harm2map(kmap,iau=iau)
 
+        def _draw(self,seed,real=False):
+                # Each seed (an int or tuple of ints) gets its own Generator stream,
+                # so a realization never depends on which chunk or thread made it.
+                rng = np.random.default_rng(seed)
+                if real: return enmap.fft(enmap.enmap(rng.standard_normal(self.shape),self.wcs))
+                return rng.standard_normal(self.shape)+1j*rng.standard_normal(self.shape)
+
+        def _get_chunk(self,seeds,scalar=False,iau=True,real=False):
+                rand = enmap.empty((len(seeds),)+tuple(self.shape),self.wcs,dtype=np.complex128)
+                for i,seed in enumerate(seeds): rand[i] = self._draw(seed,real=real)
+                covsqrt = np.asarray(self.covsqrt)
+                if len(self.shape)==2 and covsqrt.ndim==4: covsqrt = covsqrt[0,0]
+                if covsqrt.ndim<=3:
+                        kmap = enmap.ndmap(covsqrt*rand, self.wcs)
+                else:
+                        # Batched map_mul as a multiply-add over the (few) components,
+                        # which beats einsum for complex stacks and skips empty blocks
+                        kmap = enmap.zeros(rand.shape,self.wcs,dtype=rand.dtype)
+                        for a in range(covsqrt.shape[0]):
+                                for b in range(covsqrt.shape[1]):
+                                        if np.any(covsqrt[a,b]): kmap[:,a] += covsqrt[a,b]*rand[:,b]
+                if scalar or len(self.shape)==2:
+                        return enmap.ifft(kmap).real
+                else:
+                        return enmap.harm2map(kmap,iau=iau)
+
+        def iter_maps(self,seeds,chunk_size=16,nthread=None,scalar=False,iau=True,real=False):
+                """
+                Yield one realization per seed in seeds, in order. Realizations are
+                made chunk_size at a time with covsqrt applied to the whole chunk,
+                and up to nthread chunks are made concurrently on a thread pool
+                (serially if nthread is None). Each realization depends only on its
+                seed, not on chunk_size or nthread.
+                """
+                seeds = list(seeds)
+                chunks = [seeds[i:i+chunk_size] for i in range(0,len(seeds),chunk_size)]
+                kwargs = {'scalar':scalar,'iau':iau,'real':real}
+                if nthread is None or nthread<=1:
+                        for chunk in chunks:
+                                for imap in self._get_chunk(chunk,**kwargs): yield imap
+                        return
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=nthread) as pool:
+                        # Keep at most nthread chunks in flight to bound memory
+                        pending = [pool.submit(self._get_chunk,chunk,**kwargs) for chunk in chunks[:nthread]]
+                        for i in range(len(chunks)):
+                                omaps = pending.pop(0).result()
+                                if i+nthread<len(chunks): pending.append(pool.submit(self._get_chunk,chunks[i+nthread],**kwargs))
+                                for imap in omaps: yield imap
+
+        def get_maps(self,seeds,chunk_size=16,nthread=None,scalar=False,iau=True,real=False):
+                """
+                Return a stack of realizations of shape (len(seeds),)+shape, one per seed.
+                See iter_maps for the arguments.
+                """
+                omaps = list(self.iter_maps(seeds,chunk_size=chunk_size,nthread=nthread,scalar=scalar,iau=iau,real=real))
+                return enmap.enmap(np.stack(omaps),self.wcs)
+
 
 def spec1d_to_2d(shape,wcs,ps):
     return enmap.spec2flat(shape,wcs,ps)/(np.prod(shape[-2:])/enmap.area(shape,wcs ))
     
+def load_fft_wisdom(fname):
+    """Import FFTW wisdom saved by save_fft_wisdom, if the file exists and pyfftw is available."""
+    if pyfftw is None or not(os.path.exists(fname)): return False
+    with open(fname,'rb') as f:
+        return pyfftw.import_wisdom(pickle.load(f))
+
+def save_fft_wisdom(fname):
+    """Save the accumulated FFTW wisdom so later runs can skip planning."""
+    if pyfftw is None: return
+    with open(fname,'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(),f,protocol=pickle.HIGHEST_PROTOCOL)
+
+
 class FourierCalc(object):
     """
     Once you know the shape and wcs of an ndmap, you can pre-calculate some things
     to speed up fourier transforms and power spectra.
+
+    If pyfftw is available, FFTW plans are made once per (transform, array shape,
+    dtype) and reused by every call, and real maps can be transformed with
+    rfft/irfft on the half plane. Otherwise the pixell.fft routines are used.
+    Instances may be shared between threads.
     """
 
-    def __init__(self,shape,wcs,iau=True):
-        """Initialize with a geometry shape and wcs."""
+    def __init__(self,shape,wcs,iau=True,nthread=0,wisdom_file=None,flags=('FFTW_ESTIMATE',)):
+        """Initialize with a geometry shape and wcs.
+
+        nthread -- FFT threads; 0 uses pixell's default (OMP_NUM_THREADS or all cores)
+        wisdom_file -- FFTW wisdom is loaded from this file if it exists; call
+        save_wisdom to write it after plans have been made
+        flags -- FFTW planner flags. ('FFTW_MEASURE',) makes faster plans at a
+        planning cost of seconds per shape, worth it for many transforms of one
+        shape or with saved wisdom (FFTW keeps wisdom per process, so later
+        instances plan the same shape quickly).
+        """
         
         self.shape = shape
         self.wcs = wcs
         self.normfact = enmap.area(self.shape,self.wcs )/ np.prod(self.shape[-2:])**2.         
         if len(shape) > 2 and shape[-3] > 1:
             self.rot = enmap.queb_rotmat(enmap.lmap(shape,wcs),iau=iau)
+        self.nthread = nthread
+        self.flags = flags
+        self.wisdom_file = wisdom_file
+        self._plans = {}
+        self._plans_lock = threading.Lock()
+        if wisdom_file is not None: load_fft_wisdom(wisdom_file)
+
+    def save_wisdom(self,fname=None):
+        save_fft_wisdom(fname if fname is not None else self.wisdom_file)
+
+    def _plan(self,kind,ishape,dtype,nthread):
+        # each plan comes with a lock guarding its buffers
+        key = (kind,ishape,np.dtype(dtype).str,nthread)
+        with self._plans_lock:
+            if key in self._plans: return self._plans[key]
+            Nx = self.shape[-1]
+            ctype = np.result_type(dtype,0j)
+            rtype = np.zeros(1,ctype).real.dtype
+            if kind=='fft':
+                iarr = pyfftw.empty_aligned(ishape,dtype=ctype)
+                oarr = pyfftw.empty_aligned(ishape,dtype=ctype)
+            elif kind=='ifft':
+                iarr = pyfftw.empty_aligned(ishape,dtype=ctype)
+                oarr = pyfftw.empty_aligned(ishape,dtype=ctype)
+            elif kind=='rfft':
+                iarr = pyfftw.empty_aligned(ishape,dtype=rtype)
+                oarr = pyfftw.empty_aligned(ishape[:-1]+(Nx//2+1,),dtype=ctype)
+            elif kind=='irfft':
+                iarr = pyfftw.empty_aligned(ishape,dtype=ctype)
+                oarr = pyfftw.empty_aligned(ishape[:-1]+(Nx,),dtype=rtype)
+            direction = 'FFTW_BACKWARD' if kind in ['ifft','irfft'] else 'FFTW_FORWARD'
+            plan = pyfftw.FFTW(iarr,oarr,axes=(-2,-1),direction=direction,
+                               flags=self.flags,threads=nthread or enfft.nthread_fft)
+            self._plans[key] = (plan,threading.Lock())
+            return self._plans[key]
+
+    def _transform(self,kind,arr,nthread=0):
+        """Unnormalized forward or 1/N-normalized backward 2D transform of arr."""
+        nthread = nthread or self.nthread
+        arr = np.asarray(arr)
+        if pyfftw is None:
+            if kind=='fft': return enfft.fft(arr+0j,axes=[-2,-1],nthread=nthread)
+            if kind=='ifft': return enfft.ifft(arr+0j,axes=[-2,-1],nthread=nthread,normalize=True)
+            if kind=='rfft': return enfft.rfft(arr,axes=[-2,-1],nthread=nthread)
+            if kind=='irfft': return enfft.irfft(arr+0j,n=self.shape[-1],axes=[-2,-1],nthread=nthread,normalize=True)
+        plan,lock = self._plan(kind,arr.shape,arr.dtype,nthread)
+        # always go through the plan's own buffers (c2r transforms overwrite their
+        # input), holding the plan's lock so concurrent callers do not mix data
+        with lock:
+            plan.input_array[...] = arr
+            plan(normalise_idft=True)
+            return plan.output_array.copy()
 
     def iqu2teb(self,emap, nthread=0, normalize=True, rot=True):
         """Performs the 2d FFT of the enmap pixels, returning a complex enmap.
         Similar to harm2map, but uses a pre-calculated self.rot matrix.
         """
-        emap = enmap.samewcs(enmap.fft(emap,nthread=nthread,normalize=normalize), emap)
+        kmap = self._transform('fft',emap,nthread)
+        if normalize:
+            kmap /= np.prod(emap.shape[-2:])**0.5
+            if normalize in ["phy","phys","physical"]: kmap *= emap.pixsize()**0.5
+        emap = enmap.samewcs(kmap, emap)
         if emap.ndim > 2 and emap.shape[-3] > 1 and rot:
             emap[...,-2:,:,:] = enmap.map_mul(self.rot, emap[...,-2:,:,:])
 
@@ -425,16 +592,30 @@ class FourierCalc(object):
         return np.real(np.conjugate(kmap1)*kmap2)*norm,kmap1
 
     def ifft(self,kmap):
-        return enmap.enmap(ifft(kmap,axes=[-2,-1],normalize=True),self.wcs)
+        return enmap.enmap(self._transform('ifft',kmap),self.wcs)
     
     def fft(self,emap):
-        return enmap.samewcs(enmap.fft(emap,normalize=False), emap)
+        return enmap.samewcs(self._transform('fft',emap), emap)
+
+    def rfft(self,emap):
+        """Unnormalized FFT of a real map on the half plane, shape (...,Ny,Nx//2+1)."""
+        return self._transform('rfft',emap)
+
+    def irfft(self,kmap):
+        """Inverse of rfft, returning a real enmap."""
+        return enmap.enmap(self._transform('irfft',kmap),self.wcs)
         
 
-    def power2d(self,emap=None, emap2=None,nthread=0,pixel_units=False,skip_cross=False,rot=True, kmap=None, kmap2=None, dtype=None):
+    def power2d(self,emap=None, emap2=None,nthread=0,pixel_units=False,skip_cross=False,rot=True, kmap=None, kmap2=None, dtype=None, packed=False):
         """
         Calculate the power spectrum of emap crossed with emap2 (=emap if None)
         Returns in radians^2 by default unles pixel_units specified
+
+        For more than one component, each row of pairs Re(conj(a_i) b_j), j>=i,
+        is computed in one broadcast pass over the real and imaginary parts,
+        without complex temporaries. dtype (e.g. np.float32) sets the working
+        and output precision. If packed is True, only the upper triangle is
+        stored and returned as a SymMat instead of a (ncomp,ncomp,Ny,Nx) array.
         """
         wcs = emap.wcs if emap is not None else kmap.wcs
         if kmap is not None:
@@ -454,14 +635,32 @@ class FourierCalc(object):
         assert lteb1.shape==lteb2.shape
                 
         if ndim > 2 and ncomp > 1:
-            retpow = np.zeros((ncomp,ncomp,lteb1.shape[-2],lteb1.shape[-1]),dtype=dtype)
+            if dtype is None: dtype = np.float64
+            norm = 1. if pixel_units else self.normfact
+            # Re(conj(a_i) b_j) for row i against all j>=i at once, from
+            # real and imaginary parts so no complex products are formed
+            re1,im1 = lteb1.real.astype(dtype,copy=False),lteb1.imag.astype(dtype,copy=False)
+            if lteb2 is lteb1:
+                re2,im2 = re1,im1
+            else:
+                re2,im2 = lteb2.real.astype(dtype,copy=False),lteb2.imag.astype(dtype,copy=False)
+            Ny,Nx = lteb1.shape[-2:]
+            if packed:
+                retpow = SymMat(ncomp,(Ny,Nx),data=np.zeros((ncomp*(ncomp+1)//2,Ny,Nx),dtype=dtype))
+            else:
+                retpow = np.zeros((ncomp,ncomp,Ny,Nx),dtype=dtype)
             for i in range(ncomp):
-                retpow[i,i] = self.f2power(lteb1[i],lteb2[i],pixel_units)
-            if not(skip_cross):
-                for i in range(ncomp):
-                    for j in range(i+1,ncomp):
-                        retpow[i,j] = self.f2power(lteb1[i],lteb2[j],pixel_units)
-                        retpow[j,i] = retpow[i,j]
+                j1 = i+1 if skip_cross else ncomp
+                if packed:
+                    k = retpow.yx_to_k(i,i)
+                    out = retpow.data[k:k+j1-i]
+                else:
+                    out = retpow[i,i:j1]
+                np.multiply(re1[i],re2[i:j1],out=out)
+                out += im1[i]*im2[i:j1]
+                out *= norm
+                # keep the symmetric convention of the pairwise version for distinct maps
+                if not(packed): retpow[i+1:j1,i] = out[1:]
             return retpow,lteb1,lteb2
         else:
             if lteb1.ndim>2:
@@ -625,7 +824,7 @@ def get_real_attributes_generic(Ny,Nx,pixScaleY,pixScaleX):
     yy =  (np.arange(Ny)-Ny/2.+0.5)*pixScaleY
     
     ix = np.mod(np.arange(Nx*Ny),Nx)
-    iy = np.arange(Nx*Ny)/Nx
+    iy = np.arange(Nx*Ny)//Nx
     
     modRMap = np.zeros([Ny,Nx])
     modRMap[iy,ix] = np.sqrt(xx[ix]**2 + yy[iy]**2)
@@ -1030,111 +1229,177 @@ def resolution(shape,wcs):
     return res
 
 
-def inpaint_cg(imap,rand_map,mask,power2d,eps=1.e-8):
+class InpaintCG(object):
+    """
+    Constrained-realization inpainting by conjugate gradient, after Thibaut Louis.
+
+    The pixels where mask is zero are filled with a Gaussian constrained realization
+    given the rest of the map, a random map with the same power and the 2D S+N power.
+    Everything that depends only on the mask and power (1/power2d on the half plane,
+    FFT plans and the preconditioner) is computed once, so the same object can be used
+    to inpaint many maps. Maps passed to solve can have any leading dimensions
+    (e.g. a stack of sims or I/Q/U components); they are solved together, sharing
+    every FFT, with separate CG step sizes and convergence for each map.
+    """
+
+    def __init__(self,mask,power2d,precon='auto',nthread=0,max_coarse=2000):
+        """
+        mask -- 1 where the map is kept and 0 in the holes; (Ny,Nx) or broadcastable
+        against the maps to be inpainted
+        power2d -- 2d S+N power : IMPORTANT, this must be non-zero up to pixel scale.
+        (Ny,Nx) or broadcastable against the maps, in the layout of enmap.fft
+        precon -- None, 'diag', 'multigrid' or 'auto'. 'diag' applies power2d (diagonal in
+        Fourier space) inside the holes, which helps for large holes. 'multigrid' adds a
+        Jacobi smoother to an exact solve on a grid coarsened into square blocks of pixels,
+        with at most max_coarse blocks covering the holes; it needs a 2d mask and power2d.
+        It takes fewer iterations than 'diag' for many small holes (e.g. point sources)
+        and more for large contiguous ones. 'auto' uses 'diag'.
+        nthread -- FFT threads
+        """
+        # Only the FFTs of FourierCalc are used, so any wcs will do for plain arrays
+        wcs = mask.wcs if isinstance(mask,enmap.ndmap) else wcsutils.WCS(naxis=2)
+        mask = np.asarray(mask)
+        power2d = np.asarray(power2d)
+        Ny,Nx = mask.shape[-2:]
+        self.fc = FourierCalc((Ny,Nx),wcs,nthread=nthread)
+        # The real part of a full-plane product only sees the even part of the filter
+        flip = lambda a: np.roll(np.flip(a,(-2,-1)),1,(-2,-1))
+        ipower = 1./power2d
+        ipower = 0.5*(ipower+flip(ipower))
+        self.ipower = ipower[...,:Nx//2+1]
+        self.py = mask
+        self.px = 1.-mask
+        if precon=='auto': precon = 'diag'
+        if precon not in [None,'diag','multigrid']: raise ValueError("Unknown preconditioner %s" % precon)
+        self.precon = precon
+        # Without holes there is nothing to solve for
+        self.empty = not(np.any(self.px))
+        if precon=='diag':
+            self.power = (0.5*(power2d+flip(power2d)))[...,:Nx//2+1]
+        elif precon=='multigrid' and not(self.empty):
+            # Jacobi smoother: every diagonal element of the operator is mean(1/power2d)
+            self._diag = ipower.mean()
+            self._init_multigrid(max_coarse)
+
+    def _init_multigrid(self,max_coarse):
+        import scipy.sparse, scipy.linalg
+        if self.px.ndim!=2 or self.ipower.ndim!=2:
+            raise ValueError("The multigrid preconditioner needs a 2d mask and power2d.")
+        Ny,Nx = self.px.shape
+        iy,ix = np.nonzero(self.px)
+        block = 2
+        while True:
+            nbx = -(-Nx//block)
+            cells,cid = np.unique((iy//block)*nbx+ix//block,return_inverse=True)
+            if cells.size<=max_coarse: break
+            block *= 2
+        self.block = block
+        self._restrict = scipy.sparse.csr_matrix((self.px[iy,ix],(cid.ravel(),iy*Nx+ix)),shape=(cells.size,Ny*Nx))
+        # Coarse operator for whole blocks. C^-1 is stationary, so it is a lookup into
+        # the C^-1 correlation of two boxes, which stays positive definite.
+        box = np.zeros((Ny,Nx))
+        box[:block,:block] = 1.
+        kbox = self.fc._transform('rfft',box)
+        kern = self.fc._transform('irfft',self.ipower*np.abs(kbox)**2.)
+        cy,cx = (cells//nbx)*block,(cells%nbx)*block
+        acoarse = kern[(cy[None,:]-cy[:,None])%Ny,(cx[None,:]-cx[:,None])%Nx]
+        self._coarse = scipy.linalg.cho_factor(acoarse)
+
+    def _filter(self,imap,kfilter):
+        return self.fc._transform('irfft',self.fc._transform('rfft',imap)*kfilter)
+
+    def apply(self,x):
+        """The CG operator P_x C^-1 P_x restricted to the holes."""
+        return self.px*self._filter(self.px*x,self.ipower)
+
+    def precondition(self,r):
+        if self.precon is None: return r.copy()
+        if self.precon=='diag': return self.px*self._filter(self.px*r,self.power)
+        import scipy.linalg
+        shape = r.shape
+        rflat = r.reshape((-1,shape[-2]*shape[-1]))
+        coarse = scipy.linalg.cho_solve(self._coarse,self._restrict.dot(rflat.T))
+        return self.px*r/self._diag + self._restrict.T.dot(coarse).T.reshape(shape)
+
+    def solve(self,imaps,rand_maps,eps=1.e-8,maxiter=2000,return_info=False):
+        """
+        Returns the inpainted maps, with the same shape as imaps.
+
+        imaps -- masked maps, (...,Ny,Nx)
+        rand_maps -- random maps with the same power, broadcastable against imaps
+        eps -- each map stops once its residual norm falls below eps times the norm of
+        the right hand side (CG starts from zero)
+        maxiter -- maximum number of iterations
+        return_info -- also return a dict with the number of iterations 'niter' and final
+        relative residual 'residual' of each map, the relative residual history
+        'residuals' with shape (niter+1,...), and the wall 'time' (s)
+        """
+        t0 = time.time()
+        omaps = imaps
+        imaps = np.asarray(imaps)
+        if self.empty:
+            rebuild_map = enmap.samewcs(imaps.copy(),omaps)
+            if not(return_info): return rebuild_map
+            zero = np.zeros(imaps.shape[:-2])
+            return rebuild_map,{'niter':zero.astype(int),'residual':zero,'residuals':zero[None],'time':time.time()-t0}
+        rand_maps = np.broadcast_to(rand_maps,imaps.shape)
+        dot = lambda a,b: np.sum(a*b,axis=(-2,-1))
+        expand = lambda a: a[...,None,None]
+        b = -self.px*self._filter(self.py*(imaps-rand_maps),self.ipower)
+        x = np.zeros(b.shape)
+        r = b.copy()
+        z = self.precondition(r)
+        d = z.copy()
+        rz = dot(r,z)
+        delta_o = dot(r,r)
+        delta_o = np.where(delta_o>0,delta_o,1.)
+        residuals = [np.sqrt(dot(r,r)/delta_o)]
+        niter = np.zeros(rz.shape,dtype=int)
+        active = residuals[0]>eps
+        i = 0
+        while i<maxiter and np.any(active):
+            q = self.apply(d)
+            dq = dot(d,q)
+            alpha = np.where(active,rz/np.where(active,dq,1.),0.)
+            x += expand(alpha)*d
+            if (i+1)%50==0:
+                # Refresh the residual to avoid accumulated round-off
+                r = b-self.apply(x)
+            else:
+                r -= expand(alpha)*q
+            z = self.precondition(r)
+            rz_new = dot(r,z)
+            beta = np.where(active,rz_new/np.where(active,rz,1.),0.)
+            d = z+expand(beta)*d
+            rz = rz_new
+            niter += active
+            i += 1
+            residuals.append(np.sqrt(dot(r,r)/delta_o))
+            active &= residuals[-1]>eps
+        rebuild_map = enmap.samewcs(imaps*self.py+x+rand_maps*self.px,omaps)
+        if not(return_info): return rebuild_map
+        info = {'niter':niter,'residual':residuals[-1],'residuals':np.array(residuals),'time':time.time()-t0}
+        return rebuild_map,info
+
+
+def inpaint_cg(imap,rand_map,mask,power2d,eps=1.e-8,maxiter=2000,precon='auto',return_info=False):
 
     """
     by Thibaut Louis
 
-    imap  -- masked map
+    imap  -- masked map, (Ny,Nx) or a stack (...,Ny,Nx) that is solved together
     rand_map  -- random map with same power
     mask -- mask
     power2d -- 2d S+N power : IMPORTANT, this must be non-zero up to pixel scale
-    eps
+    eps -- relative residual tolerance
+    maxiter -- maximum number of iterations
+    precon -- None, 'diag', 'multigrid' or 'auto'; see InpaintCG
+    return_info -- also return the dict of iteration counts, residuals and timing
 
+    To inpaint many maps with the same mask and power, make an InpaintCG once
+    and call its solve method.
     """
-
-    assert imap.ndim==2
-    nyside,nxside = imap.shape
-    
-    def apply_px_c_inv_px(my_map):
-        
-        my_map.shape=(nyside,nxside)
-        #apply x_proj
-        my_new_map=(1-mask)*my_map
-        # change to Fourrier representation
-        a_l = fft(my_new_map,axes=[-2,-1])
-        # apply inverse power spectrum
-        a_l=a_l*1/power2d
-        # change back to pixel representation
-        my_new_map = ifft(a_l,normalize=True,axes=[-2,-1])
-        #Remove the imaginary part
-        my_new_map=my_new_map.real
-        # apply x_proj
-        my_new_map=(1-mask)*my_new_map
-        #Array to vector
-        my_new_map.shape=(nxside*nyside,)
-        my_map.shape=(nxside*nyside,)
-        return(my_new_map)
-    
-    def apply_px_c_inv_py(my_map):
-        # apply y_proj
-        my_map.shape=(nyside,nxside)
-        my_new_map=mask*my_map
-        # change to Fourrier representation
-        a_l = fft(my_new_map,axes=[-2,-1])
-        # apply inverse power spectrum
-        a_l=a_l*1/power2d
-        # change back to pixel representation
-        my_new_map = ifft(a_l,normalize=True,axes=[-2,-1])
-        #Remove the imaginary part
-        my_new_map=my_new_map.real
-        # apply x_proj
-        my_new_map=(1-mask)*my_new_map
-        #Array to vector
-        my_new_map.shape=(nxside*nyside,)
-        return(my_new_map)
-    
-    b=-apply_px_c_inv_py(imap-rand_map)
-    
-    #Number of iterations
-    i_max=2000
-    
-    #initial value of x
-    x=b
-    i=0
-    
-    r=b-apply_px_c_inv_px(x)
-    d=r
-    
-    delta_new=np.inner(r,r)
-    delta_o=delta_new
-    
-    delta_array=np.zeros(shape=(i_max))
-    
-    while i<i_max and delta_new > eps**2*delta_o:
-        # print ("")
-        # print ("number of iterations:", i)
-        # print ("")
-        # print ("eps**2*delta_o=",eps**2*delta_o)
-        # print ("")
-        # print ("delta new=",delta_new)
-        
-        q=apply_px_c_inv_px(d)
-        alpha=delta_new/(np.inner(d,q))
-        x=x+alpha*d
-        
-        if i/50.<np.int(i/50):
-            
-            r=b-apply_px_c_inv_px(x)
-        else:
-            r=r-alpha*q
-        
-        delta_old=delta_new
-        delta_new=np.inner(r,r)
-        beta=delta_new/delta_old
-        d=r+beta*d
-        i=i+1
-    
-    #print "delta_o=", delta_o
-    #print "delta_new=", delta_new
-    
-    x.shape=(nyside,nxside)
-    x_old=x
-    x=x+rand_map*(1-mask)
-    complete=imap*mask
-    rebuild_map=complete+x
-    print("Num iterations : ",i)
-    return rebuild_map
+    return InpaintCG(mask,power2d,precon=precon).solve(imap,rand_map,eps=eps,maxiter=maxiter,return_info=return_info)
 
 
 ## WORKING WITH DATA
@@ -1153,13 +1418,14 @@ class DataNoise(object):
 class NoiseModel(object):
     # Deprecated?
 
-    def __init__(self,splits=None,wmap=None,mask=None,kmask=None,directory=None,spec_smooth_width=2.,skip_beam=True,skip_mask=True,skip_kmask=True,skip_cross=True,iau=False):
+    def __init__(self,splits=None,wmap=None,mask=None,kmask=None,directory=None,spec_smooth_width=2.,skip_beam=True,skip_mask=True,skip_kmask=True,skip_cross=True,iau=False,cache_dir=None,comm=None):
         """
         shape, wcs for geometry
         unmasked splits
         hit counts wmap
         real-space mask that must include a taper. Can be 3-dimensional if Q/U different from I.
         k-space kmask
+        cache_dir, comm: passed to MapGen to cache the noise covsqrt
         """
 
         if directory is not None:
@@ -1198,7 +1464,7 @@ class NoiseModel(object):
             self.wmap = wmap
             self.shape = shape
             self.wcs = wcs
-        self.ngen = MapGen(self.shape,self.wcs,self.noise2d)
+        self.ngen = MapGen(self.shape,self.wcs,self.noise2d,cache_dir=cache_dir,comm=comm)
         # self.noise_modulation = 1./np.sqrt(self.wmap)/np.sqrt(np.mean((1./self.wmap)))
         wt = 1./np.sqrt(self.wmap)
         wtw2 = np.mean(1./wt**2.)
@@ -1293,75 +1559,86 @@ def split_calc(isplits,jsplits,icoadd,jcoadd,fourier_calc=None,alt=True):
     
     
         
-def noise_from_splits(splits,fourier_calc=None,nthread=0,do_cross=True):
+def noise_from_splits(splits,fourier_calc=None,nthread=0,do_cross=True,read_kwargs=None,pairwise=False):
     """
     Calculate noise power spectra by subtracting cross power of splits 
     from autopower of splits. Optionally calculate cross power spectra
     of T,E,B from I,Q,U.
 
-    splits -- (nsplits,ncomp,Ny,Nx) arrays
+    splits -- (nsplits,ncomp,Ny,Nx) arrays, or any iterable of (ncomp,Ny,Nx)
+    maps or of map filenames (e.g. interfaces.DR2.get_map(splits=True,filenames=True)).
+    Splits are read and transformed one at a time, so peak memory does not
+    grow with the number of splits.
+    read_kwargs -- passed to enmap.read_map for splits given as filenames
+    pairwise -- reproduce the output of earlier versions, which summed the
+    Nsplits*(Nsplits-1)/2 pairs i<j explicitly. This keeps every split
+    transform in memory, and the returned cross power is left in I,Q,U,
+    since the old rotation to T,E,B never fired.
 
     ncomp can be 1 for T only, or 3 for I,Q,U
     ncomp could be > 3 for e.g. I1,Q1,U1,I2,Q2,U2 for 2 arrays
 
+    The mean of the Nsplits*(Nsplits-1)/2 cross spectra is obtained from
+    the power of the coadd and the sum of the split autos,
+      sum_{i<j} P(s_i,s_j) = ( P(sum_i s_i) - sum_i P(s_i) ) / 2,
+    so only one running sum of split transforms and one of auto spectra
+    are kept. This changes the output relative to pairwise=True: cross
+    spectra between different components are averaged over both orderings
+    of each pair of splits, and the cross power is rotated to T,E,B.
+    The diagonal of the noise is unchanged.
     """
-
-    try:
-        wcs = splits.wcs
-    except:
-        wcs = splits[0].wcs
-        
-    splits = enmap.enmap(np.asarray(splits),wcs).astype(np.float32)
-    assert splits.ndim==3 or splits.ndim==4
-    if splits.ndim == 3: splits = splits[:,None,:,:]
-    ncomp = splits.shape[1]
-    ndim = splits.ndim
-        
-    if fourier_calc is None:
-        shape = splits.shape[-3:] if do_cross else splits.shape[-2:]
-        fourier_calc = FourierCalc(shape,wcs)
-    
-    Nsplits = splits.shape[0]
-
-    if do_cross: assert ncomp==3 or ncomp==1
-
-
-    # Get fourier transforms of I,Q,U
-    ksplits = [fourier_calc.iqu2teb(split, nthread=nthread, normalize=False, rot=False) for split in splits]
-    del splits
-    
-    if do_cross:
-        kteb_splits = []
-        # Rotate I,Q,U to T,E,B for cross power (not necssary for noise)
-        for ksplit in ksplits:
-            kteb_splits.append( ksplit.copy())
-            if (ndim==3 and ncomp==3):
-                kteb_splits[-1][...,-2:,:,:] = enmap.map_mul(fourier_calc.rot, kteb_splits[-1][...,-2:,:,:])
-            
-    # get auto power of I,Q,U
+    if read_kwargs is None: read_kwargs = {}
+    Nsplits = 0
+    ksum = 0.
     auto = 0.
-    for ksplit in ksplits:
-        auto += fourier_calc.power2d(kmap=ksplit)[0]
-    auto /= Nsplits
-
-    # do cross powers of I,Q,U
+    ksplits = []
+    for split in splits:
+        if isinstance(split,six.string_types): split = enmap.read_map(split,**read_kwargs)
+        wcs = split.wcs
+        split = enmap.enmap(np.asarray(split),wcs).astype(np.float32)
+        assert split.ndim==2 or split.ndim==3
+        if split.ndim == 2: split = split[None,:,:]
+        ncomp = split.shape[0]
+        if fourier_calc is None:
+            shape = split.shape[-3:] if do_cross else split.shape[-2:]
+            fourier_calc = FourierCalc(shape,wcs)
+        if do_cross: assert ncomp==3 or ncomp==1
+
+        # Get fourier transforms of I,Q,U and accumulate their sum and auto power
+        ksplit = fourier_calc.iqu2teb(split, nthread=nthread, normalize=False, rot=False)
+        ksum = ksum + ksplit.astype(np.complex128)
+        auto = auto + fourier_calc.power2d(kmap=ksplit)[0]
+        if pairwise: ksplits.append(ksplit)
+        Nsplits += 1
+        del split,ksplit
+    assert Nsplits>1, "At least two splits are needed."
+    ksum = enmap.enmap(ksum,wcs)
     Ncrosses = (Nsplits*(Nsplits-1)/2)
-    cross = 0.
-    for i in range(len(ksplits)):
-        for j in range(i+1,len(ksplits)):
-            cross += fourier_calc.power2d(kmap=ksplits[i],kmap2=ksplits[j])[0]
-    cross /= Ncrosses
-        
-    if do_cross:
-        # do cross powers of T,E,B
-        cross_teb = 0.
-        for i in range(len(ksplits)):
-            for j in range(i+1,len(ksplits)):
-                cross_teb += fourier_calc.power2d(kmap=kteb_splits[i],kmap2=kteb_splits[j])[0]
-        cross_teb /= Ncrosses
+    if pairwise:
+        # The old explicit mean over pairs i<j
+        cross = 0.
+        for i in range(Nsplits):
+            for j in range(i+1,Nsplits):
+                cross += fourier_calc.power2d(kmap=ksplits[i],kmap2=ksplits[j])[0]
+        cross /= Ncrosses
+        del ksplits
+        cross_teb = cross.copy() if do_cross else None
     else:
-        cross_teb = None
-    del ksplits
+        cross = (fourier_calc.power2d(kmap=ksum)[0]-auto)/2./Ncrosses
+        if do_cross and ncomp==3:
+            # Rotate I,Q,U to T,E,B for cross power (not necssary for noise).
+            # The rotation is real, so it acts on the sum of autos as R A R^T.
+            rot = np.zeros((3,3)+ksum.shape[-2:])
+            rot[0,0] = 1.
+            rot[1:,1:] = fourier_calc.rot
+            ksum = enmap.map_mul(rot,ksum)
+            auto_teb = np.einsum("ab...,bc...,dc...->ad...",rot,auto,rot)
+            cross_teb = (fourier_calc.power2d(kmap=ksum)[0]-auto_teb)/2./Ncrosses
+        elif do_cross:
+            cross_teb = cross.copy()
+        else:
+            cross_teb = None
+    auto /= Nsplits
 
     # get noise model for I,Q,U
     noise = (auto-cross)/Nsplits
@@ -1373,58 +1650,127 @@ def noise_from_splits(splits,fourier_calc=None,nthread=0,do_cross=True):
 ### FULL SKY
 
 class HealpixProjector(object):
-    def __init__(self,shape,wcs,rot=None,ncomp=1):
+    """
+    Projects HEALPix maps (or their alms) onto a fixed CAR geometry. The
+    (optionally rotated) pixel positions are computed once, SHT plans are
+    kept per (nside,lmax), and a batch of maps can be projected in one call.
+    """
+    def __init__(self,shape,wcs,rot=None,ncomp=1,cache_dir=None,verbose=False):
+        """
+        rot -- e.g. "gal,equ" to project maps in the first system onto a geometry in the second
+        cache_dir -- directory in which to cache the rotated pixel positions and polarization
+        angles, keyed by a hash of the geometry and rotation
+        verbose -- print progress
+        """
         from pixell import coordinates
+        self.verbose = verbose
         self.pmap = enmap.posmap(shape, wcs)
         
         assert ncomp == 1 or ncomp == 3, "Only 1 or 3 components supported"
         pmap = self.pmap
         
         if rot:
-            # Rotate by displacing coordinates and then fixing the polarization
-            print("Computing pixel positions")
-            if rot:
-                print("Computing rotated positions")
+            key = io.hash_arrays("HealpixProjector",str(tuple(shape[-2:])),wcs.to_header_string(),rot,ncomp)
+            cached = io.load_array_cache(cache_dir,key) if cache_dir is not None else None
+            if cached is not None:
+                if verbose: print("Loading rotated positions from ", cache_dir)
+                pmap[...] = cached['pmap']
+                if 'psi' in cached: self.psi = np.asarray(cached['psi'])
+            else:
+                # Rotate by displacing coordinates and then fixing the polarization
+                if verbose: print("Computing rotated positions")
                 s1,s2 = rot.split(",")
                 opos = coordinates.transform(s2, s1, pmap[::-1], pol=ncomp==3)
                 pmap[...] = opos[1::-1]
                 if len(opos) == 3: self.psi = -opos[2].copy()
                 del opos
+                if cache_dir is not None:
+                    arrays = {'pmap':np.asarray(pmap)}
+                    if ncomp==3: arrays['psi'] = self.psi
+                    io.save_array_cache(cache_dir,key,arrays)
         self.ncomp = ncomp
         self.rot = rot
-        
-    def project(self,ihealmap=None,hpmap=None,unit=1,lmax=0,first=0,return_hp=False):
-        from pixell import sharp, coordinates, curvedsky
-        import healpy as hp
-
-        dtype = np.float64
-        ctype = np.result_type(dtype,0j)
-        # Read the input maps
-        print("Reading " + str(ihealmap))
-        hpmap = hp.read_map(ihealmap, field=tuple(range(first,first+self.ncomp))) if hpmap is None else hpmap
-        m = np.atleast_2d(hpmap).astype(dtype)
-        if unit != 1: m /= unit
-        # Prepare the transformation
-        print("Preparing SHT")
-        nside = hp.npix2nside(m.shape[1])
+        self._plans = {}
+
+    def _plan(self,nside,lmax):
+        """SHT plan for a HEALPix map of given nside, made once per (nside,lmax)."""
+        key = (nside,lmax)
+        if key not in self._plans:
+            if self.verbose: print("Preparing SHT")
+            try:
+                from pixell import sharp
+            except ImportError:
+                # pixell >= 0.20 has no libsharp; curvedsky transforms need only an alm_info
+                from pixell import curvedsky
+                self._plans[key] = (None,curvedsky.alm_info(lmax),None)
+            else:
+                minfo = sharp.map_info_healpix(nside)
+                ainfo = sharp.alm_info(lmax)
+                self._plans[key] = (minfo,ainfo,sharp.sht(minfo, ainfo))
+        return self._plans[key]
+
+    def map2alm(self,m,lmax=0):
+        """alms of HEALPix maps m with shape (...,ncomp,npix), up to lmax (3*nside by default)."""
+        nside = hp.npix2nside(m.shape[-1])
         lmax  = lmax or 3*nside
-        minfo = sharp.map_info_healpix(nside)
-        ainfo = sharp.alm_info(lmax)
-        sht   = sharp.sht(minfo, ainfo)
-        alm   = np.zeros((self.ncomp,ainfo.nelem), dtype=ctype)
-        # Perform the actual transform
-        print("T -> alm")
-        print( m.dtype, alm.dtype)
-        sht.map2alm(m[0], alm[0])
-        if self.ncomp == 3:
-            print("P -> alm")
-            sht.map2alm(m[1:3],alm[1:3], spin=2)
+        minfo,ainfo,sht = self._plan(nside,lmax)
+        ctype = np.result_type(m.dtype,0j)
+        alm   = np.zeros(m.shape[:-1]+(ainfo.nelem,), dtype=ctype)
+        if sht is None:
+            from pixell import curvedsky
+            curvedsky.map2alm_healpix(m, alm=alm, ainfo=ainfo, spin=[0,2] if self.ncomp==3 else 0)
+            return alm
+        for mi,almi in zip(m.reshape((-1,)+m.shape[-2:]),alm.reshape((-1,)+alm.shape[-2:])):
+            sht.map2alm(mi[0], almi[0])
+            if self.ncomp == 3: sht.map2alm(mi[1:3],almi[1:3], spin=2)
+        return alm
+
+    def project(self,ihealmap=None,hpmap=None,unit=1,lmax=0,first=0,return_hp=False,alm=None,verbose=None):
+        """
+        Project HEALPix maps onto the CAR geometry of this projector.
 
-        print("Projecting")
+        ihealmap -- HEALPix filename, or a list of filenames to project as a batch
+        hpmap -- HEALPix map(s) instead of a file: (npix), (ncomp,npix), or a batch (nmaps,ncomp,npix);
+                 with ncomp=1, (nmaps,npix) is also a batch
+        alm -- alms instead of a map: (ncomp,nalm) or a batch (nmaps,ncomp,nalm)
+        unit -- the maps (or alms) are divided by unit
+        lmax -- band limit of the SHT, 3*nside by default
+        first -- first field read from the file(s)
+
+        Returns (ncomp,Ny,Nx) for a single map, or (nmaps,ncomp,Ny,Nx) for a batch.
+        """
+        from pixell import curvedsky
+        if verbose is None: verbose = self.verbose
+        dtype = np.float64
+        m = None
+        if alm is None:
+            if hpmap is None:
+                # Read the input maps
+                fields = tuple(range(first,first+self.ncomp))
+                if isinstance(ihealmap,six.string_types):
+                    if verbose: print("Reading " + str(ihealmap))
+                    hpmap = hp.read_map(ihealmap, field=fields)
+                else:
+                    if verbose: print("Reading " + str(len(ihealmap)) + " maps")
+                    hpmap = np.stack([np.atleast_2d(hp.read_map(fname, field=fields)) for fname in ihealmap])
+            m = np.asarray(hpmap).astype(dtype)
+            if m.ndim==1: m = m[None]
+            # with one component, a 2d array is a batch of scalar maps
+            if m.ndim==2 and self.ncomp==1 and m.shape[0]>1: m = m[:,None]
+            if m.shape[-2]!=self.ncomp:
+                raise ValueError("Expected %d component(s) in the HEALPix map(s) of shape %s." % (self.ncomp,str(m.shape)))
+            if unit != 1: m /= unit
+            if verbose: print("T -> alm" if self.ncomp==1 else "TP -> alm")
+            alm = self.map2alm(m,lmax)
+        else:
+            alm = np.asarray(alm)
+            if unit != 1: alm = alm/unit
+        
+        if verbose: print("Projecting")
         res  = curvedsky.alm2map_pos(alm, self.pmap)
         if self.rot and self.ncomp==3:
-            print("Rotating polarization vectors")
-            res[1:3] = enmap.rotate_pol(res[1:3], self.psi)
+            if verbose: print("Rotating polarization vectors")
+            res[...,1:3,:,:] = enmap.rotate_pol(res[...,1:3,:,:], self.psi)
 
         if return_hp:
             return res,m
@@ -1975,6 +2321,19 @@ class Stacker(object):
         assert self.shape==cutout.shape
         return enmap.ndmap(cutout,self.wcs)
 
+    def cutouts(self,ra,dec,stack=False,chunk_size=4096):
+        """
+        Batch version of cutout for arrays ra,dec. Objects whose stamp would fall off
+        the map are dropped. Returns the (nobj,Npix,Npix) stamps (or their mean if stack
+        is True) and the indices of the objects that were kept. See maps.cutouts.
+        """
+        iy,ix = self.imap.sky2pix(coords=np.array([dec,ra]))
+        Npix = int(self.Npix)
+        y0 = np.floor(iy-self.Npix/2).astype(int)
+        x0 = np.floor(ix-self.Npix/2).astype(int)
+        res,index = _gather_stamps(self.imap,y0,x0,Npix,None,stack,chunk_size)
+        return enmap.ndmap(res,self.wcs),index
+
 
 def cutout_slice(shape,wcs,arcmin_width=None,ra=None,dec=None,iy=None,ix=None,pad=1,corner=False,res=None,Npix=None):
     Ny,Nx = shape
@@ -2010,6 +2369,72 @@ def cutout(imap,arcmin_width=None,ra=None,dec=None,iy=None,ix=None,pad=1,corner=
         return enmap.enmap(cutout,wcs)
 
 
+def _gather_stamps(imap,y0,x0,Npix,keep,stack,chunk_size):
+    """
+    Gather the (Npix,Npix) stamps of imap with lower corners y0,x0, for the
+    objects selected by the boolean array keep (all if None) that lie fully
+    inside the map. Stamps are read with one fancy index per chunk of objects.
+    Returns (nobj,...,Npix,Npix) stamps, or their mean over objects if stack
+    is True, and the indices kept.
+    """
+    Ny,Nx = imap.shape[-2:]
+    y0 = np.asarray(y0,dtype=int).ravel()
+    x0 = np.asarray(x0,dtype=int).ravel()
+    inside = (y0>=0) & (x0>=0) & (y0+Npix<=Ny) & (x0+Npix<=Nx)
+    index = np.nonzero(inside if keep is None else (inside & keep))[0]
+    arr = np.asarray(imap)
+    pre = arr.shape[:-2]
+    offs = np.arange(Npix)
+    if stack:
+        res = np.zeros(pre+(Npix,Npix),dtype=arr.dtype)
+    else:
+        res = np.empty((index.size,)+pre+(Npix,Npix),dtype=arr.dtype)
+    for i in range(0,index.size,chunk_size):
+        sel = index[i:i+chunk_size]
+        Y = (y0[sel][:,None]+offs)[:,:,None]
+        X = (x0[sel][:,None]+offs)[:,None,:]
+        # advanced indices on the last two axes give (...,nchunk,Npix,Npix)
+        stamps = np.moveaxis(arr[...,Y,X],-3,0)
+        if stack:
+            res += stamps.sum(axis=0)
+        else:
+            res[i:i+sel.size] = stamps
+    if stack and index.size>0: res /= index.size
+    return res,index
+
+def cutouts(imap,arcmin_width=None,ra=None,dec=None,iy=None,ix=None,pad=1,corner=False,res=None,Npix=None,proj="car",stack=False,chunk_size=4096):
+    """
+    Batch version of cutout for arrays of positions ra,dec (radians) or pixels iy,ix.
+
+    All positions are converted with one sky2pix call, objects that cutout would
+    reject at the edges are dropped, and the remaining stamps are gathered
+    chunk_size objects at a time with fancy indexing. Stamps are placed as in
+    cutout, except that every stamp has exactly Npix pixels a side.
+
+    Returns an enmap of shape (nobj,...,Npix,Npix) on the stamp geometry, and the
+    indices of the objects that were kept. If stack is True, returns instead the
+    mean stamp, accumulated chunk by chunk without holding every stamp in memory.
+    """
+    shape,wcs = imap.shape[-2:],imap.wcs
+    if (iy is None) or (ix is None):
+        iy,ix = enmap.sky2pix(shape,wcs,coords=np.array([np.ravel(dec),np.ravel(ra)]),corner=corner)
+    iy,ix = np.ravel(iy),np.ravel(ix)
+    if res is None:
+        res = np.min(enmap.extent(shape,wcs)/shape[-2:])*180./np.pi*60.
+    else:
+        res = res*180./np.pi*60.
+    if Npix is None: Npix = int(arcmin_width/res)
+    Ny,Nx = shape
+    fround = (lambda x: np.floor(x).astype(int)) if corner else (lambda x: np.round(x).astype(int))
+    # same edge cut as cutout_slice
+    keep = (fround(iy-Npix/2)>=pad) & (fround(ix-Npix/2)>=pad) & (fround(iy+Npix/2)<=(Ny-pad)) & (fround(ix+Npix/2)<=(Nx-pad))
+    y0 = fround(iy-Npix/2.+0.5)
+    x0 = fround(ix-Npix/2.+0.5)
+    stamps,index = _gather_stamps(imap,y0,x0,Npix,keep,stack,chunk_size)
+    oshape,owcs = enmap.geometry(pos=(0.,0.),res=res/(180./np.pi*60.),shape=(Npix,Npix),proj=proj)
+    return enmap.enmap(stamps,owcs),index
+
+
 def aperture_photometry(instamp,aperture_radius,annulus_width,modrmap=None):
     # inputs in radians, outputs in arcmin^2
     stamp = instamp.copy()
@@ -2023,6 +2448,20 @@ def aperture_photometry(instamp,aperture_radius,annulus_width,modrmap=None):
 
 
 
+def read_map_mmap(fname,hdu=0):
+    """
+    Memory-map the image in a FITS file as an ndmap instead of reading it into memory.
+    The file is closed on return; the mapping lives as long as the returned array.
+    """
+    import astropy.io.fits, warnings
+    with astropy.io.fits.open(fname,memmap=True) as hdul:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            wcs = wcsutils.WCS(hdul[hdu].header).sub(2)
+        data = hdul[hdu].data
+    return enmap.ndmap(data,wcs)
+
+
 class InterpStack(object):
 
     def __init__(self,arc_width,px,proj="car"):
@@ -2078,6 +2517,69 @@ class InterpStack(object):
         
         return self._rot_cut(submap,ra_rad,dec_rad,**kwargs)
 
+    def cutouts(self,imap,ra,dec,chunk_size=256,nthread=None,stack=False,**kwargs):
+        """
+        Catalog version of cutout for arrays ra,dec (degrees).
+
+        imap -- the parent ndmap, or a FITS filename that is memory-mapped once
+        instead of being re-read for each object
+        chunk_size -- objects rotated and interpolated together
+        nthread -- if given, chunks run on a thread pool of this size
+        stack -- return the mean stamp instead of every stamp
+        kwargs -- interpolation options (mode, order, border, cval) as for enmap.at
+
+        The spline prefiltering of the parent map is done once for all objects, and
+        the target pixel positions of a whole chunk are rotated in one vectorized call.
+        Objects centred off the parent map are dropped. Returns the stamps with shape
+        (nobj,...,Ny,Nx) on the target geometry (or their mean) and the indices of the
+        objects that were kept. Stamps have the dtype of imap (float64 for integer maps).
+        """
+        from pixell import utils, coordinates
+        if isinstance(imap,six.string_types): imap = read_map_mmap(imap)
+        ra_rad = np.deg2rad(np.ravel(ra))
+        dec_rad = np.deg2rad(np.ravel(dec))
+        pix = enmap.sky2pix(imap.shape,imap.wcs,np.array([dec_rad,ra_rad]))
+        Ny,Nx = imap.shape[-2:]
+        index = np.nonzero((pix[0]>=0) & (pix[0]<=Ny-1) & (pix[1]>=0) & (pix[1]<=Nx-1))[0]
+        ip = utils.interpolator(imap,imap.ndim-2,**kwargs)
+        # target pixels as unit vectors, to be rotated to every object at once
+        rect = utils.ang2rect(np.array([self.lra,self.ldec]),False)
+        pre = imap.shape[:-2]
+        # stamps keep the precision of the map, in native byte order (FITS data is big-endian)
+        dtype = np.result_type(imap.dtype,np.float32).newbyteorder('=')
+
+        def _chunk(sel):
+            # Same rotation as coordinates.recenter, with one matrix per object
+            rot = coordinates.euler_mat([ra_rad[sel],self.dect-dec_rad[sel],np.full(sel.size,-self.rat)],"zyz")
+            pos = utils.rect2ang(np.einsum("nij,jp->inp",rot,rect),False)
+            pix_new = enmap.sky2pix(imap.shape,imap.wcs,pos[::-1])
+            stamps = ip(pix_new).reshape(pre+(sel.size,)+tuple(self.shape_target[-2:]))
+            stamps = np.moveaxis(stamps,-3,0)
+            return stamps.sum(axis=0) if stack else stamps
+
+        chunks = [index[i:i+chunk_size] for i in range(0,index.size,chunk_size)]
+        if nthread is None or nthread<=1:
+            res = self._collect(map(_chunk,chunks),index.size,pre,stack,dtype)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=nthread) as pool:
+                res = self._collect(pool.map(_chunk,chunks),index.size,pre,stack,dtype)
+        return enmap.enmap(res,self.wcs_target),index
+
+    def _collect(self,results,nobj,pre,stack,dtype):
+        shape = pre+tuple(self.shape_target[-2:])
+        if stack:
+            res = np.zeros(shape,dtype=np.result_type(dtype,np.float64))
+            for r in results: res += r
+            if nobj>0: res /= nobj
+            return res.astype(dtype)
+        res = np.empty((nobj,)+shape,dtype=dtype)
+        i = 0
+        for r in results:
+            res[i:i+len(r)] = r
+            i += len(r)
+        return res
+
     def _box_from_ra_dec(self,ra_rad,dec_rad):
 
         
@@ -38,6 +38,111 @@ class fakeMpiComm:
         pass
 
 
+ANY_SOURCE = -1
+ANY_TAG = -1
+IN_PLACE = "IN_PLACE"
+
+def _buf(spec):
+    # mpi4py buffer specs may be an array or a list like [array,(counts,displs)]
+    return spec[0] if isinstance(spec,(list,tuple)) else spec
+
+class LocalComm(object):
+    """
+    The subset of the mpi4py communicator interface used in orphics, for
+    ranks that are local processes started by run_local. Messages travel
+    through one multiprocessing queue per rank, and collectives are built
+    on point-to-point messages through root. Reduction ops are binary
+    functions like np.add (MPI.SUM when mpi4py is missing).
+    """
+    def __init__(self,rank,size,queues,counter=None):
+        self.rank = rank
+        self.size = size
+        self.queues = queues
+        self.counter = counter
+        self._pending = []
+        self._ncoll = 0
+    def Get_rank(self):
+        return self.rank
+    def Get_size(self):
+        return self.size
+    def Abort(self,errorcode=1):
+        os._exit(errorcode)
+
+    def send(self,obj,dest,tag=0):
+        self.queues[dest].put((self.rank,tag,obj))
+    def recv(self,buf=None,source=ANY_SOURCE,tag=ANY_TAG,status=None):
+        match = lambda s,t: (source in [ANY_SOURCE,s]) and (t==tag or (tag==ANY_TAG and not(isinstance(t,tuple))))
+        for i,(s,t,obj) in enumerate(self._pending):
+            if match(s,t): return self._pending.pop(i)[2]
+        while True:
+            s,t,obj = self.queues[self.rank].get()
+            if match(s,t): return obj
+            self._pending.append((s,t,obj))
+    def Send(self,buf,dest,tag=0):
+        self.send(np.array(_buf(buf)),dest,tag)
+    def Recv(self,buf,source=ANY_SOURCE,tag=ANY_TAG,status=None):
+        buf = _buf(buf)
+        buf[...] = self.recv(source=source,tag=tag).reshape(buf.shape)
+
+    def _ctag(self):
+        # Collectives are called in the same order on all ranks, so a
+        # sequence number keeps their messages apart from user tags
+        self._ncoll += 1
+        return ("coll",self._ncoll)
+    def bcast(self,obj,root=0):
+        tag = self._ctag()
+        if self.rank!=root: return self.recv(source=root,tag=tag)
+        for r in range(self.size):
+            if r!=root: self.send(obj,r,tag)
+        return obj
+    def gather(self,obj,root=0):
+        tag = self._ctag()
+        if self.rank!=root:
+            self.send(obj,root,tag)
+            return None
+        return [obj if r==root else self.recv(source=r,tag=tag) for r in range(self.size)]
+    def allgather(self,obj):
+        return self.bcast(self.gather(obj))
+    def Barrier(self):
+        self.allgather(None)
+    def reduce(self,obj,op=np.add,root=0):
+        objs = self.gather(obj,root=root)
+        if self.rank!=root: return None
+        ret = objs[0]
+        for o in objs[1:]: ret = op(ret,o)
+        return ret
+    def allreduce(self,obj,op=np.add):
+        return self.bcast(self.reduce(obj,op=op))
+    def Reduce(self,sendbuf,recvbuf,op=np.add,root=0):
+        sendbuf = _buf(recvbuf) if sendbuf is IN_PLACE else _buf(sendbuf)
+        ret = self.reduce(np.asarray(sendbuf),op=op,root=root)
+        if self.rank==root: _buf(recvbuf)[...] = ret.reshape(_buf(recvbuf).shape)
+    def Allreduce(self,sendbuf,recvbuf,op=np.add):
+        sendbuf = _buf(recvbuf) if sendbuf is IN_PLACE else _buf(sendbuf)
+        _buf(recvbuf)[...] = self.allreduce(np.asarray(sendbuf),op=op).reshape(_buf(recvbuf).shape)
+    def Gatherv(self,sendbuf,recvbuf,root=0):
+        pieces = self.gather(np.array(_buf(sendbuf)).ravel(),root=root)
+        if self.rank!=root: return
+        out,(counts,displs) = recvbuf
+        out = out.reshape(-1)
+        for piece,c,d in zip(pieces,counts,displs): out[d:d+c] = piece[:c]
+    def Alltoallv(self,sendbuf,recvbuf):
+        tag = self._ctag()
+        sbuf,(scounts,sdispls) = sendbuf
+        rbuf,(rcounts,rdispls) = recvbuf
+        sbuf = np.asarray(sbuf).reshape(-1)
+        rbuf = rbuf.reshape(-1)
+        for r in range(self.size):
+            if r!=self.rank: self.send(sbuf[sdispls[r]:sdispls[r]+scounts[r]].copy(),r,tag)
+        for r in range(self.size):
+            c,d = rcounts[r],rdispls[r]
+            rbuf[d:d+c] = sbuf[sdispls[r]:sdispls[r]+c] if r==self.rank else self.recv(source=r,tag=tag)
+    def fetch_and_add(self,incr):
+        # Shared counter used by DynamicTasks in place of an MPI window
+        with self.counter.get_lock():
+            ret = self.counter.value
+            self.counter.value += incr
+        return ret
 
 
 try:
@@ -45,13 +150,20 @@ try:
     from mpi4py import MPI
 except:
 
-    if not(disable_mpi): print("WARNING: mpi4py could not be loaded. Falling back to fake MPI. This means that if you submitted multiple processes, they will all be assigned the same rank of 0, and they are potentially doing the same thing.")
+    if not(disable_mpi): print("WARNING: mpi4py could not be loaded. Falling back to fake MPI. This means that if you submitted multiple processes, they will all be assigned the same rank of 0, and they are potentially doing the same thing. To use several local processes instead, run python -m orphics.mpi -n N script.py")
     
     class template:
         pass
 
     MPI = template()
     MPI.COMM_WORLD = fakeMpiComm()
+    MPI.ANY_SOURCE = ANY_SOURCE
+    MPI.ANY_TAG = ANY_TAG
+    MPI.IN_PLACE = IN_PLACE
+    MPI.SUM = np.add
+    MPI.PROD = np.multiply
+    MPI.MAX = np.maximum
+    MPI.MIN = np.minimum
 
 
 def mpi_distribute(num_tasks,avail_cores,allow_empty=False):
@@ -71,6 +183,43 @@ def mpi_distribute(num_tasks,avail_cores,allow_empty=False):
     
 
 
+def transpose_rows(arr,num_each,comm):
+    """
+    Distributed transpose of an (N,N) matrix split into contiguous row blocks,
+    where rank i holds num_each[i] rows (e.g. from mpi_distribute). arr is this
+    rank's (num_each[rank],N) block, and the same rows of the transpose are
+    returned. Uses a single Alltoallv, so as long as callers only build
+    their own block, no rank ever holds the full matrix.
+    """
+    rank = comm.Get_rank()
+    numcores = comm.Get_size()
+    if numcores==1: return np.ascontiguousarray(arr.T)
+    num_each = np.asarray(num_each)
+    starts = np.append(0,np.cumsum(num_each)[:-1])
+    nloc = num_each[rank]
+    sendbuf = np.concatenate([arr[:,s:s+n].ravel() for s,n in zip(starts,num_each)])
+    counts = nloc*num_each
+    displs = np.append(0,np.cumsum(counts)[:-1])
+    recvbuf = np.empty(counts.sum(),dtype=arr.dtype)
+    comm.Alltoallv([sendbuf,(counts,displs)],[recvbuf,(counts,displs)])
+    blocks = [recvbuf[d:d+c].reshape((n,nloc)) for d,c,n in zip(displs,counts,num_each)]
+    return np.ascontiguousarray(np.concatenate(blocks,axis=0).T)
+
+def gather_rows(arr,num_each,comm,root=0):
+    """
+    Gather contiguous row blocks of a matrix (as in transpose_rows) on root.
+    Returns the full matrix on root and None elsewhere.
+    """
+    rank = comm.Get_rank()
+    numcores = comm.Get_size()
+    if numcores==1: return arr
+    ncols = arr.shape[1]
+    counts = np.asarray(num_each)*ncols
+    displs = np.append(0,np.cumsum(counts)[:-1])
+    recvbuf = np.empty((np.sum(num_each),ncols),dtype=arr.dtype) if rank==root else None
+    comm.Gatherv(np.ascontiguousarray(arr),[recvbuf,(counts,displs)],root=root)
+    return recvbuf
+
 def distribute(njobs,verbose=True,**kwargs):
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
@@ -81,6 +230,179 @@ def distribute(njobs,verbose=True,**kwargs):
     return comm,rank,my_tasks
 
 
+class DynamicTasks(object):
+    """
+    Hands out task indices on demand instead of in fixed contiguous blocks,
+    so ranks that draw cheap tasks simply take more of them. The next free
+    position is a shared counter on rank 0, advanced with an MPI one-sided
+    Fetch_and_op (a shared multiprocessing value under LocalComm); no rank
+    is dedicated to scheduling.
+
+    Iterate over the object to get this rank's tasks. A rank may stop
+    early (break or an exception); the tasks it does not claim go to the
+    others. The counter window is freed collectively, so every rank must
+    call close() (or report(), which calls it) once it is done, or use the
+    object as a context manager. Under fakeMpiComm or a single process the
+    tasks are simply run in order.
+    """
+
+    def __init__(self,tasks,comm=None,chunk_size=1):
+        """
+        tasks -- number of tasks, or a list of task indices (e.g. from Stats.resume)
+        comm -- defaults to MPI.COMM_WORLD
+        chunk_size -- number of consecutive tasks claimed per counter update
+        """
+        self.tasks = list(range(tasks)) if isinstance(tasks,(int,np.integer)) else list(tasks)
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        self.rank = self.comm.Get_rank()
+        self.numcores = self.comm.Get_size()
+        self.chunk_size = chunk_size
+        self.done = []
+        self.busy = 0.
+        self.wall = 0.
+        self._serial = self.numcores==1 or isinstance(self.comm,fakeMpiComm)
+        self._win = None
+        if isinstance(self.comm,LocalComm) and not(self._serial):
+            self.comm.Barrier()
+            if self.rank==0: self.comm.counter.value = 0
+            self.comm.Barrier()
+        elif not(self._serial):
+            self._win = MPI.Win.Allocate(8 if self.rank==0 else 0,disp_unit=8,comm=self.comm)
+            if self.rank==0:
+                counter = np.frombuffer(self._win.tomemory(),dtype=np.int64)
+                counter[0] = 0
+            self.comm.Barrier()
+
+    def _claim(self):
+        if self._serial:
+            start = len(self.done)
+        elif isinstance(self.comm,LocalComm):
+            start = self.comm.fetch_and_add(self.chunk_size)
+        else:
+            incr = np.array([self.chunk_size],dtype=np.int64)
+            start = np.zeros(1,dtype=np.int64)
+            self._win.Lock(0,MPI.LOCK_SHARED)
+            self._win.Fetch_and_op(incr,start,0,0,MPI.SUM)
+            self._win.Unlock(0)
+            start = int(start[0])
+        return self.tasks[start:start+self.chunk_size]
+
+    def __iter__(self):
+        t0 = time.time()
+        try:
+            while True:
+                chunk = self._claim()
+                if len(chunk)==0: break
+                for task in chunk:
+                    t1 = time.time()
+                    yield task
+                    self.busy += time.time()-t1
+                    self.done.append(task)
+        finally:
+            self.wall = time.time()-t0
+
+    def close(self):
+        """
+        Free the shared counter. Collective: call it on every rank, after
+        that rank has stopped iterating. Calling it again does nothing.
+        """
+        if self._win is not None:
+            self._win.Free()
+            self._win = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def report(self,verbose=True,root=0):
+        """
+        Gather the number of tasks and the busy time (spent in the loop body)
+        of every rank on root. Utilization is the busy time over the slowest
+        rank's wall time. Closes the object first, so it must be called on
+        every rank. Returns a dict of per-rank arrays on root, None elsewhere.
+        """
+        self.close()
+        mine = (len(self.done),self.busy,self.wall)
+        allr = [mine] if self._serial else self.comm.gather(mine,root=root)
+        if self.rank!=root: return None
+        ntasks,busy,wall = [np.array(x) for x in zip(*allr)]
+        ret = {'ntasks':ntasks,'busy':busy,'wall':wall,'utilization':busy/max(wall.max(),1e-30)}
+        if verbose:
+            print("rank  ntasks    busy (s)  utilization")
+            for r in range(ntasks.size):
+                print("%4d %7d %11.2f %11.1f%%" % (r,ntasks[r],busy[r],100.*ret['utilization'][r]))
+            print("Mean utilization : %.1f%%" % (100.*ret['utilization'].mean()))
+        return ret
+
+
+def dynamic_distribute(tasks,chunk_size=1,comm=None,verbose=True):
+    """
+    Like distribute, but my_tasks is a DynamicTasks iterable that hands out
+    tasks on demand (see DynamicTasks). Call my_tasks.close() or
+    my_tasks.report() on every rank once done.
+    """
+    my_tasks = DynamicTasks(tasks,comm=comm,chunk_size=chunk_size)
+    if my_tasks.rank==0 and verbose: print ("Dynamically scheduling ", len(my_tasks.tasks), " tasks over ", my_tasks.numcores, " cores...")
+    return my_tasks.comm,my_tasks.rank,my_tasks
+
+
+def _local_main(target,rank,size,queues,counter,results,args):
+    from orphics import mpi
+    mpi.MPI.COMM_WORLD = mpi.LocalComm(rank,size,queues,counter)
+    if isinstance(target,str):
+        import runpy
+        sys.argv = [target]+list(args)
+        runpy.run_path(target,run_name="__main__")
+        ret = None
+    else:
+        ret = target(*args)
+    results.put((rank,ret))
+
+def run_local(target,nproc,args=()):
+    """
+    Run an MPI-style program on nproc local processes without an MPI install.
+    Each process gets a LocalComm as MPI.COMM_WORLD, so code written against
+    orphics.mpi (distribute, Stats, MPIDict, ...) runs unchanged.
+
+    target -- path of a script, run as __main__ with sys.argv = [target]+args,
+              or an importable function, called as target(*args)
+    Returns the list of return values of target ordered by rank (None for scripts).
+    The same is available from the command line as
+        python -m orphics.mpi -n 8 script.py [args...]
+    """
+    import multiprocessing as mp
+    import queue
+    # Fresh interpreters, with mpi4py disabled so that MPI is the plain template
+    ctx = mp.get_context("spawn")
+    queues = [ctx.Queue() for i in range(nproc)]
+    counter = ctx.Value('q',0)
+    results = ctx.Queue()
+    old = os.environ.get('DISABLE_MPI')
+    os.environ['DISABLE_MPI'] = "true"
+    try:
+        procs = [ctx.Process(target=_local_main,args=(target,rank,nproc,queues,counter,results,args)) for rank in range(nproc)]
+        for p in procs: p.start()
+    finally:
+        if old is None: del os.environ['DISABLE_MPI']
+        else: os.environ['DISABLE_MPI'] = old
+    rets = [None]*nproc
+    nret = 0
+    while nret<nproc:
+        try:
+            rank,ret = results.get(timeout=0.1)
+            rets[rank] = ret
+            nret += 1
+        except queue.Empty:
+            failed = [(rank,p.exitcode) for rank,p in enumerate(procs) if p.exitcode not in [None,0]]
+            if len(failed)>0:
+                for p in procs: p.terminate()
+                raise RuntimeError("Local rank %d exited with code %d." % failed[0])
+    for p in procs: p.join()
+    return rets
+
+
 class MPIDict(object):
 
     def __init__(self,init_dict,comm):
@@ -219,3 +541,13 @@ class jobMaker:
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
         self._jobLog.write("\nClosed jobMaker object named =="+self.name+"== at "+timestamp)
         self._jobLog.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Run an MPI-style script on local processes without mpi4py.')
+    parser.add_argument("-n", "--nproc",    type=int,  default=os.cpu_count(),help="Number of processes")
+    parser.add_argument("script", type=str,help='Script to run')
+    parser.add_argument("args", nargs=argparse.REMAINDER,help='Arguments for the script')
+    args = parser.parse_args()
+    run_local(os.path.abspath(args.script),args.nproc,args.args)
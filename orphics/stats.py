@@ -604,10 +604,22 @@ class Stats(object):
     of 1d measurements or 2d stacks.
     """
     
-    def __init__(self,comm=None,root=0,loopover=None,tag_start=333):
+    def __init__(self,comm=None,root=0,loopover=None,tag_start=333,streaming=False,checkpoint=None,checkpoint_every=1):
         """
         comm - MPI.COMM_WORLD object
         tag_start - MPI comm tags start at this integer
+        checkpoint - if not None, path prefix of per-rank checkpoint files
+        (checkpoint+"_rank<rank>.npz") holding the vectors or moments, the
+        stacks and counts, and the indices of finished tasks. See resume
+        and task_done.
+        checkpoint_every - write the checkpoint after this many task_done calls
+        streaming - if True, add_to_stats only keeps a running count, mean and
+        covariance (sum of squared deviations) per label, updated with
+        Welford's algorithm, instead of every vector. get_stats then merges
+        these moments from all cores with collective reductions, so every
+        core in comm must call it. Cores may have created different labels,
+        or none at all; a core contributes nothing to labels it lacks.
+        Raw samples in self.vectors are only kept when streaming is False.
         """
 
         if comm is not None:
@@ -622,6 +634,10 @@ class Stats(object):
         self.columns = {}
             
         self.vectors = {}
+        self.streaming = streaming
+        self.counts = {}
+        self.means = {}
+        self.m2s = {}
         self.little_stack = {}
         self.little_stack_count = {}
         self.tag_start = tag_start
@@ -630,6 +646,120 @@ class Stats(object):
             self.loopover = list(range(root+1,self.numcores))
         else:
             self.loopover = loopover
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.done = []
+        self._undumped = 0
+        self._absorbed = set()
+
+    def _checkpoint_file(self,rank):
+        return "%s_rank%d.npz" % (self.checkpoint,rank)
+
+    def save_checkpoint(self):
+        """
+        Write this rank's accumulators and finished task indices to its
+        checkpoint file. The file is replaced atomically, so a crash while
+        writing leaves the previous checkpoint intact. Each file gets a new
+        id and lists the ids of the files merged into it (see resume).
+        """
+        import os,uuid
+        arrays = {'done':np.array(self.done,dtype=np.int64),'streaming':np.array(self.streaming),
+                  'id':np.array(uuid.uuid4().hex),'absorbed':np.array(sorted(self._absorbed),dtype=str)}
+        for label in self.vectors.keys():
+            assert isinstance(label,str), "Checkpointing needs string labels."
+            arrays['columns__'+label] = np.array(self.columns[label],dtype=np.int64)
+            if self.streaming:
+                arrays['count__'+label] = np.array(self.counts[label])
+                arrays['mean__'+label] = self.means[label]
+                arrays['m2__'+label] = self.m2s[label]
+            else:
+                arrays['vectors__'+label] = np.array(self.vectors[label]).reshape((-1,)+tuple(self.columns[label]))
+        for label in self.little_stack.keys():
+            assert isinstance(label,str), "Checkpointing needs string labels."
+            arrays['stack__'+label] = np.asarray(self.little_stack[label])
+            arrays['stackcount__'+label] = np.array(self.little_stack_count[label])
+        fname = self._checkpoint_file(self.rank)
+        tmpname = fname[:-4]+".tmp.npz"
+        np.savez(tmpname,**arrays)
+        os.replace(tmpname,fname)
+        self._undumped = 0
+
+    def _load_checkpoint(self,fname):
+        with np.load(fname) as data:
+            self._absorb_checkpoint(fname,data)
+
+    def _absorb_checkpoint(self,fname,data):
+        assert bool(data['streaming'])==self.streaming, "Checkpoint %s was made with streaming=%s." % (fname,bool(data['streaming']))
+        self.done += data['done'].tolist()
+        self._absorbed.add(str(data['id']))
+        self._absorbed.update(data['absorbed'].tolist())
+        for key in data.files:
+            if key.startswith('columns__'):
+                label = key[len('columns__'):]
+                columns = tuple(data[key].tolist())
+                self.add_to_stats(label,np.zeros(columns),exclude=True)
+                if self.streaming:
+                    self.counts[label],self.means[label],self.m2s[label] = merge_moments(
+                        self.counts[label],self.means[label],self.m2s[label],
+                        int(data['count__'+label]),data['mean__'+label],data['m2__'+label])
+                else:
+                    self.vectors[label] += list(data['vectors__'+label])
+            elif key.startswith('stack__'):
+                label = key[len('stack__'):]
+                self.add_to_stack(label,data[key],exclude=True)
+                self.little_stack[label] = self.little_stack[label] + data[key]
+                self.little_stack_count[label] += int(data['stackcount__'+label])
+
+    def resume(self,tasks):
+        """
+        Load the checkpoints of a previous run and return the subset of tasks
+        (e.g. this rank's share from mpi_distribute) that are not done yet.
+
+        Every rank must call this. The previous run may have used a different
+        number of ranks: old rank i's file is absorbed by rank i % numcores,
+        which immediately checkpoints the merged state and removes the other
+        files it absorbed. The merged file records the ids of the files it
+        absorbed, so if a crash leaves one of them behind, the next resume
+        deletes it instead of counting its data twice. Finished task indices
+        are shared between ranks, so a task done by any old rank is skipped.
+        """
+        import os,glob,re
+        if self.checkpoint is None: return list(tasks)
+        files = []
+        for fname in glob.glob(self.checkpoint+"_rank*.npz"):
+            match = re.match(re.escape(self.checkpoint)+r"_rank(\d+)\.npz$",fname)
+            if match is not None: files.append((int(match.group(1)),fname))
+        ids,stale = {},set()
+        for old,fname in files:
+            with np.load(fname) as data:
+                ids[fname] = str(data['id'])
+                stale.update(data['absorbed'].tolist())
+        # nobody rewrites or removes files until every rank has read their ids
+        self.comm.Barrier()
+        absorbed = []
+        for old,fname in files:
+            if old % self.numcores != self.rank: continue
+            if ids[fname] in stale:
+                os.remove(fname)
+                continue
+            self._load_checkpoint(fname)
+            absorbed.append(fname)
+        if absorbed: self.save_checkpoint()
+        for fname in absorbed:
+            if fname!=self._checkpoint_file(self.rank): os.remove(fname)
+        done = set(self.done)
+        if self.numcores>1:
+            for theirs in self.comm.allgather(self.done): done.update(theirs)
+        return [task for task in tasks if task not in done]
+
+    def task_done(self,index):
+        """
+        Record task index as finished (after its vectors and stacks were added)
+        and write the checkpoint every checkpoint_every calls.
+        """
+        self.done.append(index)
+        self._undumped += 1
+        if self.checkpoint is not None and self._undumped>=self.checkpoint_every: self.save_checkpoint()
 
     def add_to_stats(self,label,vector,exclude=False):
         """
@@ -642,7 +772,18 @@ class Stats(object):
         if not(label in list(self.vectors.keys())):
             self.vectors[label] = []
             self.columns[label] = vector.shape
-        if not(exclude):
+            if self.streaming:
+                self.counts[label] = 0
+                self.means[label] = np.zeros(vector.size)
+                self.m2s[label] = np.zeros((vector.size,vector.size))
+        if exclude: return
+        if self.streaming:
+            x = vector.reshape(-1).astype(np.float64)
+            self.counts[label] += 1
+            delta = x-self.means[label]
+            self.means[label] += delta/self.counts[label]
+            self.m2s[label] += np.outer(delta,x-self.means[label])
+        else:
             self.vectors[label].append(vector)
 
 
@@ -663,49 +804,120 @@ class Stats(object):
     def get_stacks(self,verbose=True):
         """
         Collect from all MPI cores and calculate stacks.
-        """
 
-        if self.rank in self.loopover:
-
-            for k,label in enumerate(self.little_stack.keys()):
-                self.comm.send(self.little_stack_count[label], dest=self.root, tag=self.tag_start*3000+k)
-            
-            for k,label in enumerate(self.little_stack.keys()):
-                send_dat = np.array(self.little_stack[label]).astype(np.float64)
-                self.comm.Send(send_dat, dest=self.root, tag=self.tag_start*10+k)
-
-        elif self.rank==self.root:
+        Every core in comm must call this. The union of stack labels (and
+        their shapes) is agreed with an allgather, so cores may have
+        created different labels; a core without a label contributes
+        nothing to it. Each label's count and stack are then summed on
+        root with one Reduce of a packed buffer. Cores outside root and
+        loopover contribute nothing.
+        """
+        from orphics.mpi import MPI
+        use = self.rank==self.root or self.rank in self.loopover
+        mine = [(label,np.shape(self.little_stack[label])) for label in self.little_stack.keys()]
+        shapes = {}
+        for theirs in (self.comm.allgather(mine) if self.numcores>1 else [mine]):
+            for label,shape in theirs:
+                if label in shapes: assert shapes[label]==shape, "Stack %s has different shapes on different cores." % str(label)
+                shapes[label] = shape
+        labels = sorted(shapes.keys(),key=str)
+
+        if self.rank==self.root:
             self.stacks = {}
             self.stack_count = {}
-
-            for k,label in enumerate(self.little_stack.keys()):
+        for label in labels:
+            if self.numcores==1:
                 self.stack_count[label] = self.little_stack_count[label]
-                for core in self.loopover: #range(1,self.numcores):
-                    if verbose: print("Waiting for core ", core , " / ", self.numcores)
-                    data = self.comm.recv(source=core, tag=self.tag_start*3000+k)
-                    self.stack_count[label] += data
-
-            
-            for k,label in enumerate(self.little_stack.keys()):
-                self.stacks[label] = self.little_stack[label]
-            for core in self.loopover: #range(1,self.numcores):
-                if verbose: print("Waiting for core ", core , " / ", self.numcores)
-                for k,label in enumerate(self.little_stack.keys()):
-                    expected_shape = self.little_stack[label].shape
-                    data_vessel = np.empty(expected_shape, dtype=np.float64)
-                    self.comm.Recv(data_vessel, source=core, tag=self.tag_start*10+k)
-                    self.stacks[label] += data_vessel
-
-                    
-            for k,label in enumerate(self.little_stack.keys()):                
-                self.stacks[label] /= self.stack_count[label]
+                self.stacks[label] = np.asarray(self.little_stack[label],dtype=np.float64)/self.stack_count[label]
+                continue
+            send_dat = np.zeros(1+int(np.prod(shapes[label])),dtype=np.float64)
+            if use and label in self.little_stack:
+                send_dat[0] = self.little_stack_count[label]
+                send_dat[1:] = np.asarray(self.little_stack[label]).reshape(-1)
+            recv_dat = np.empty_like(send_dat) if self.rank==self.root else None
+            self.comm.Reduce(send_dat,recv_dat,op=MPI.SUM,root=self.root)
+            if self.rank==self.root:
+                if verbose: print("Reduced stack ", label)
+                self.stack_count[label] = int(round(recv_dat[0]))
+                self.stacks[label] = recv_dat[1:].reshape(shapes[label])/self.stack_count[label]
                 
+    def _reduce_moments(self):
+        """
+        Merge the per-core (count,mean,m2) of every label on root with two
+        sum reductions over packed buffers: an Allreduce of counts and
+        count-weighted means gives the global means, and a Reduce of each
+        core's m2 plus its count times the outer product of its offset from
+        the global mean gives the global m2 (Chan et al.'s parallel update).
+        The union of labels (and their lengths) is first agreed with an
+        allgather, so every core packs the same buffer layout; a core
+        without a label contributes nothing to it, as do cores outside
+        root and loopover.
+        """
+        from orphics.mpi import MPI
+        use = self.rank==self.root or self.rank in self.loopover
+        sizes = {}
+        for theirs in self.comm.allgather([(label,self.means[label].size) for label in self.counts.keys()]):
+            for label,n in theirs:
+                if label in sizes: assert sizes[label]==n, "Vector %s has different lengths on different cores." % str(label)
+                sizes[label] = n
+        labels = sorted(sizes.keys(),key=str)
+        if len(labels)==0: return ({},{},{}) if self.rank==self.root else None
+        has = lambda label: use and label in self.counts and self.counts[label]>0
+        sizes = [sizes[label] for label in labels]
+        first = np.concatenate([np.append(self.counts[label],self.counts[label]*self.means[label]) if has(label)
+                                else np.zeros(n+1) for label,n in zip(labels,sizes)])
+        total = np.empty_like(first)
+        self.comm.Allreduce(first,total,op=MPI.SUM)
+        counts,means,i = {},{},0
+        for label,n in zip(labels,sizes):
+            counts[label] = int(round(total[i]))
+            means[label] = total[i+1:i+1+n]/counts[label] if counts[label]>0 else np.nan*np.ones(n)
+            i += n+1
+        second = []
+        for label,n in zip(labels,sizes):
+            if has(label):
+                d = self.means[label]-means[label]
+                second.append((self.m2s[label]+self.counts[label]*np.outer(d,d)).reshape(-1))
+            else:
+                second.append(np.zeros(n*n))
+        second = np.concatenate(second)
+        m2tot = np.empty_like(second) if self.rank==self.root else None
+        self.comm.Reduce(second,m2tot,op=MPI.SUM,root=self.root)
+        if self.rank!=self.root: return None
+        m2s,i = {},0
+        for label,n in zip(labels,sizes):
+            m2s[label] = m2tot[i:i+n*n].reshape((n,n))
+            i += n*n
+        return counts,means,m2s
+
     def get_stats(self,verbose=True,skip_stats=False):
         """
         Collect from all MPI cores and calculate statistics for
         1d measurements.
+
+        In streaming mode, every core must call this. On root,
+        self.stats[label] has the same keys as get_stats(vectors)
+        and self.numobj[label] is the total number of vectors.
         """
 
+        if self.streaming:
+            if self.numcores>1:
+                ret = self._reduce_moments()
+            else:
+                ret = (dict(self.counts),dict(self.means),dict(self.m2s))
+            if ret is None: return
+            counts,means,m2s = ret
+            self.stats = {}
+            self.numobj = {}
+            for label in counts.keys():
+                N = counts[label]
+                self.numobj[label] = N
+                if skip_stats: continue
+                cov = m2s[label]/(N-1) if N>1 else np.nan*m2s[label]
+                if cov.size==1: cov = cov.reshape(()) # as np.cov for one column
+                self.stats[label] = stats_from_moments(N,means[label],cov)
+            return
+
         if self.rank in self.loopover:
             for k,label in enumerate(self.vectors.keys()):
                 self.comm.send(np.array(self.vectors[label]).shape[0], dest=self.root, tag=self.tag_start*2000+k)
@@ -754,30 +966,81 @@ def npspace(minim,maxim,num,scale="lin"):
 
 
 class bin2D(object):
-    def __init__(self, modrmap, bin_edges):
+    def __init__(self, modrmap, bin_edges, sparse=False):
+        """
+        Bin maps in annuli of modrmap.
+
+        sparse -- precompute a sparse (nbins x npix) bin membership matrix so
+                  that bin() is a sparse matmul. This is also used, built on
+                  first call, whenever bin() is given a (...,Ny,Nx) stack.
+        """
         self.centers = (bin_edges[1:]+bin_edges[:-1])/2.
         self.digitized = np.digitize(modrmap.reshape(-1), bin_edges,right=True)
         self.bin_edges = bin_edges
         self.modrmap = modrmap
+        self.sparse = sparse
+        self._op = None
+        if sparse: self._operator()
+
+    def _operator(self):
+        if self._op is None:
+            from scipy.sparse import csr_matrix
+            nbins = self.centers.size
+            sel = np.logical_and(self.digitized>0,self.digitized<=nbins)
+            pix = np.nonzero(sel)[0]
+            self._op = csr_matrix((np.ones(pix.size),(self.digitized[sel]-1,pix)),shape=(nbins,self.digitized.size))
+            self._counts = np.asarray(self._op.sum(axis=1)).reshape(-1)
+        return self._op
 
     def bin(self,data2d,weights=None,err=False,get_count=False):
+        """
+        Returns centers and binned means, followed by the error on the mean
+        if err and the (weighted) pixel counts if get_count. data2d and weights
+        may be (...,Ny,Nx) stacks, in which case the binned quantities are (...,nbins).
+        """
+        if self.sparse or np.ndim(data2d)>self.modrmap.ndim or np.ndim(weights)>self.modrmap.ndim:
+            return self._bin_sparse(data2d,weights,err,get_count)
+        # the first and last bincount entries are pixels below and beyond the edges
+        nb = self.centers.size+2
         if weights is None:
-            count = np.bincount(self.digitized)[1:-1]
-            res = np.bincount(self.digitized,(data2d).reshape(-1))[1:-1]/count
+            count = np.bincount(self.digitized,minlength=nb)[1:-1]
+            res = np.bincount(self.digitized,(data2d).reshape(-1),minlength=nb)[1:-1]/count
             if err:
-                meanmap = self.modrmap.copy().reshape(-1) * 0
-                for i in range(self.centers.size): meanmap[self.digitized==i] = res[i]
-                std = np.sqrt(np.bincount(self.digitized,((data2d-meanmap.reshape(self.modrmap.shape))**2.).reshape(-1))[1:-1]/(count-1)/count)
+                meanmap = np.append(0.,res)[np.minimum(self.digitized,res.size)]
+                meanmap[self.digitized>res.size] = 0.
+                std = np.sqrt(np.bincount(self.digitized,((data2d.reshape(-1)-meanmap)**2.),minlength=nb)[1:-1]/(count-1)/count)
+        else:
+            assert not(err)
+            count = np.bincount(self.digitized,weights.reshape(-1),minlength=nb)[1:-1]
+            res = np.bincount(self.digitized,(data2d*weights).reshape(-1),minlength=nb)[1:-1]/count
+        ret = (self.centers,res)
+        if err: ret += (std,)
+        if get_count: ret += (count,)
+        return ret
+
+    def _bin_sparse(self,data2d,weights,err,get_count):
+        A = self._operator()
+        npix = self.digitized.size
+        data2d = np.asarray(data2d)
+        oshape = np.broadcast(data2d,weights).shape[:-self.modrmap.ndim] if weights is not None else data2d.shape[:-self.modrmap.ndim]
+        nbins = self.centers.size
+        # (npix,nstack) views so that each map is a column
+        d = np.broadcast_to(data2d,oshape+self.modrmap.shape).reshape((-1,npix)).T
+        if weights is None:
+            count = self._counts
+            res = (A @ d).T/count
         else:
-            count = np.bincount(self.digitized,weights.reshape(-1))[1:-1]
-            res = np.bincount(self.digitized,(data2d*weights).reshape(-1))[1:-1]/count
-        if get_count:
-            assert not(err) # need to make more general
-            return self.centers,res,count
+            assert not(err)
+            w = np.broadcast_to(weights,oshape+self.modrmap.shape).reshape((-1,npix)).T
+            count = (A @ w).T
+            res = (A @ (d*w)).T/count
         if err:
-            assert not(get_count)
-            return self.centers,res,std
-        return self.centers,res
+            resid = d - (A.T @ res.T)
+            std = np.sqrt((A @ (resid*resid)).T/(count-1)/count)
+        ret = (self.centers,res.reshape(oshape+(nbins,)))
+        if err: ret += (std.reshape(oshape+(nbins,)),)
+        if get_count: ret += (np.broadcast_to(count,res.shape).reshape(oshape+(nbins,)),)
+        return ret
 
 
 class bin1D:
@@ -845,18 +1108,35 @@ def get_stats(binned_vectors):
     arr = np.asarray(binned_vectors)
     
     N = arr.shape[0]  
+    return stats_from_moments(N,np.nanmean(arr,axis=0),np.cov(arr.transpose()))
+
+def merge_moments(n1,mean1,m2_1,n2,mean2,m2_2):
+    """
+    Combine the count, mean and sum of squared deviations (outer products)
+    of two sets of samples (Chan et al.'s pairwise update).
+    """
+    n = n1+n2
+    if n==0: return 0,mean1,m2_1
+    d = mean2-mean1
+    return n,mean1+d*(n2/n),m2_1+m2_2+np.outer(d,d)*(n1*n2/n)
+
+def stats_from_moments(N,mean,cov):
+    """
+    The dictionary of get_stats given the number of samples N,
+    their mean and their covariance.
+    """
     ret = {}
-    ret['mean'] = np.nanmean(arr,axis=0)
-    ret['cov'] = np.cov(arr.transpose())
+    ret['mean'] = mean
+    ret['cov'] = cov
     ret['covmean'] = ret['cov'] / N
-    if arr.shape[1]==1:
+    if np.size(mean)==1:
         ret['err'] = np.sqrt(ret['cov'])
     else:
         ret['err'] = np.sqrt(np.diagonal(ret['cov']))
     ret['errmean'] = ret['err'] / np.sqrt(N)
 
     # correlation matrix
-    if arr.shape[1]==1:
+    if np.size(mean)==1:
         ret['corr'] = 1.
     else:
 
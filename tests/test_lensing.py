@@ -0,0 +1,246 @@
+import os
+import numpy as np
+from pixell import enmap
+from orphics import lensing, maps, cosmology
+
+theory_root = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","data","Aug6_highAcc_CDM")
+
+def get_theory():
+    return cosmology.loadTheorySpectraFromCAMB(theory_root,unlensedEqualsLensed=False,
+                                               useTotal=False,TCMB=2.7255e6,lpad=9000,get_dimensionless=False)
+
+def get_estimator(shape,wcs,theory,**kwargs):
+    modlmap = enmap.modlmap(shape,wcs)
+    nT = modlmap*0 + (10.*np.pi/180./60.)**2.
+    kmask = maps.mask_kspace(shape,wcs,lmin=100,lmax=3000)
+    kmask_K = maps.mask_kspace(shape,wcs,lmin=20,lmax=3000)
+    return lensing.Estimator(shape,wcs,theory,theorySpectraForNorm=theory,
+                             noiseX2dTEB=[nT,2.*nT,2.*nT],noiseY2dTEB=[nT,2.*nT,2.*nT],
+                             fmaskX2dTEB=[kmask]*3,fmaskY2dTEB=[kmask]*3,fmaskKappa=kmask_K,**kwargs)
+
+def test_rfft_norm():
+    theory = get_theory()
+    # even and odd Nx to exercise the half-plane expansion; filters vanish below Nyquist
+    for npix in [(128,128),(121,109)]:
+        shape,wcs = enmap.geometry(pos=np.deg2rad([[-3,-3],[3,3]]),shape=npix,proj='car')
+        qest = get_estimator(shape,wcs,theory)
+        for XY in ['TT','EE','TE','ET']:
+            cnorm = qest.N.getNlkk2d(XY,setNl=False,rfft=False)
+            rnorm = qest.N.getNlkk2d(XY,setNl=False,rfft=True)
+            assert np.allclose(rnorm,cnorm,rtol=1e-8,atol=1e-10*np.abs(cnorm).max())
+
+def test_lensing_noise_sweep():
+    theory = get_theory()
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-3,-3],[3,3]]),shape=(64,64),proj='car')
+    modlmap = enmap.modlmap(shape,wcs)
+    bin_edges = np.arange(40,2000,100)
+    ests = ['TT','EE','EB']
+    grid = dict(noise_t=[5.,20.],beam=[1.5,3.],ellmin_t=[200],ellmax_t=[2500,3000])
+    df = lensing.lensing_noise_sweep(grid,bin_edges,estimators=ests,theory=theory,shape=shape,wcs=wcs,chunk_size=3)
+    assert len(df)==8*(len(ests)+1)*(bin_edges.size-1)
+    for nt in grid['noise_t']:
+        for beam in grid['beam']:
+            for lmax in grid['ellmax_t']:
+                n2d = (nt*np.pi/180./60.)**2./maps.gauss_beam(modlmap,beam)**2.
+                ls,nlkks,_,_ = lensing.lensing_noise(modlmap,n2d,2.*n2d,2.*n2d,200,200,200,lmax,lmax,lmax,
+                                                      bin_edges,estimators=ests,theory=theory)
+                for est in ests+['mv']:
+                    sel = df[(df.noise_t==nt)&(df.beam==beam)&(df.ellmax_t==lmax)&(df.est==est)]
+                    assert np.allclose(sel.nlkk.values,nlkks[est],rtol=1e-10,atol=0)
+
+def test_norm_cache(tmp_path):
+    theory = get_theory()
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-3,-3],[3,3]]),shape=(64,64),proj='car')
+    qest = get_estimator(shape,wcs,theory)
+    miss = get_estimator(shape,wcs,theory,cache_dir=str(tmp_path))
+    hit = get_estimator(shape,wcs,theory,cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir()))==1
+    for XY in qest.estList:
+        assert np.allclose(hit.AL[XY],qest.AL[XY])
+        assert np.allclose(hit.N.Nlkk[XY],qest.N.Nlkk[XY])
+        assert np.allclose(hit.WXY[XY],miss.WXY[XY])
+    get_estimator(shape,wcs,theory,cache_dir=str(tmp_path),gradCut=2000)
+    assert len(list(tmp_path.iterdir()))==2
+
+def test_filters_follow_noise(tmp_path):
+    theory = get_theory()
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-3,-3],[3,3]]),shape=(64,64),proj='car')
+    imap = np.random.standard_normal((3,)+shape)
+    # without a cache, in-place edits of N are picked up as before
+    qest = get_estimator(shape,wcs,theory)
+    assert len(qest.WXY)==0
+    qest.updateTEB_X(imap[0],imap[1],imap[2])
+    qest.updateTEB_Y()
+    k0 = qest.get_kappa('TT').copy()
+    qest.N.noiseXX2d['TT'] *= 4.
+    qest.N.noiseYY2d['TT'] *= 4.
+    assert not(np.allclose(qest.get_kappa('TT'),k0))
+    # filters loaded from the cache are rebuilt when N's inputs are replaced
+    qest = get_estimator(shape,wcs,theory,cache_dir=str(tmp_path))
+    qest = get_estimator(shape,wcs,theory,cache_dir=str(tmp_path))
+    qest.updateTEB_X(imap[0],imap[1],imap[2])
+    qest.updateTEB_Y()
+    k0 = qest.get_kappa('TT').copy()
+    qest.N.addNoise2DPowerXX('TT',4.*qest.N.noiseXX2d['TT'].real,qest.N.fMaskXX['TT'])
+    qest.N.addNoise2DPowerYY('TT',4.*qest.N.noiseYY2d['TT'].real,qest.N.fMaskYY['TT'])
+    k1 = qest.get_kappa('TT')
+    assert not(np.allclose(k1,k0))
+    assert np.allclose(qest.WXY['TT'],qest.N.WXY('TT'))
+    assert np.allclose(qest.WY['TT'],qest.N.WY('TT'))
+
+def test_kappa_batch():
+    theory = get_theory()
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-3,-3],[3,3]]),shape=(64,64),proj='car')
+    qest = get_estimator(shape,wcs,theory)
+    imaps = np.random.standard_normal((5,3)+shape)
+    for XY in ['TT','EB']:
+        kappas = []
+        for imap in imaps:
+            qest.updateTEB_X(imap[0],imap[1],imap[2])
+            qest.updateTEB_Y()
+            kappas.append(qest.get_kappa(XY).copy())
+        kappas = np.array(kappas)
+        bkappas = qest.get_kappa_batch(XY,imaps,chunk_size=2)
+        assert bkappas.shape==kappas.shape
+        assert np.allclose(bkappas,kappas,atol=1e-10*np.abs(kappas).max())
+        bkappas = qest.get_kappa_batch(XY,imaps,dtype=np.float32)
+        assert bkappas.dtype==np.float32
+        assert np.allclose(bkappas,kappas,atol=1e-4*np.abs(kappas).max())
+
+def test_shared_legs():
+    theory = get_theory()
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-3,-3],[3,3]]),shape=(64,64),proj='car')
+    qest = get_estimator(shape,wcs,theory)
+    imap = np.random.standard_normal((3,)+shape)
+    qest.updateTEB_X(imap[0],imap[1],imap[2])
+    qest.updateTEB_Y()
+    ests = ['TT','TE','EE','EB','TB']
+    kmv = qest.coadd_kappa(ests)
+    skmv = qest.coadd_kappa(ests,shared_legs=True)
+    assert np.allclose(skmv,kmv,atol=1e-10*np.abs(kmv).max())
+    nfft,nsep = qest.fft_counts
+    assert nfft < 0.6*nsep
+
+def test_sparse_lens_cov():
+    n = 12
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-1,-1],[1,1]]),shape=(n,n),proj='car')
+    amat = np.random.standard_normal((n*n,n*n))
+    ucov = amat @ amat.T
+    alpha_pix = enmap.pixmap(shape,wcs) + np.random.uniform(-1.5,1.5,(2,n,n))
+    kbeam = maps.gauss_beam(enmap.modlmap(shape,wcs),30.)
+    for lens_order in [1,3,5]:
+        dcov = lensing.lens_cov(shape,wcs,ucov,alpha_pix,lens_order=lens_order,kbeam=kbeam)
+        scov = lensing.lens_cov(shape,wcs,ucov,alpha_pix,lens_order=lens_order,kbeam=kbeam,sparse=True)
+        assert np.allclose(scov,dcov,atol=1e-12*np.abs(dcov).max())
+
+def test_distributed_lens_cov_pol():
+    from orphics import mpi
+    n = 8
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-1,-1],[1,1]]),shape=(n,n),proj='car')
+    amat = np.random.standard_normal((3*n*n,3*n*n))
+    ucov = np.transpose((amat @ amat.T).reshape((3,n*n,3,n*n)),(0,2,1,3))
+    alpha_pix = np.random.uniform(-0.5,0.5,(2,n,n))
+    comm = mpi.MPI.COMM_WORLD
+    dcov = lensing.lens_cov_pol((3,n,n),wcs,ucov,alpha_pix,comm=comm)
+    for sparse in [False,True]:
+        rcov = lensing.lens_cov_pol((3,n,n),wcs,ucov,alpha_pix,comm=comm,sparse=sparse,distributed=True)
+        assert np.allclose(rcov,dcov,atol=1e-12*np.abs(dcov).max())
+    fcov = lensing.lens_cov_pol((3,n,n),wcs,ucov,alpha_pix,comm=comm,sparse=True,distributed=True,dtype=np.float32)
+    assert fcov.dtype==np.float32
+    assert np.allclose(fcov,dcov,atol=1e-5*np.abs(dcov).max())
+
+def test_distributed_lens_cov_pol_ranks(tmp_path):
+    # the all-to-all path on 4 local ranks, with row blocks that straddle components
+    from orphics import mpi
+    script = tmp_path / "job.py"
+    script.write_text('''
+import sys
+import numpy as np
+from pixell import enmap
+from orphics import lensing, mpi
+comm = mpi.MPI.COMM_WORLD
+n = 7
+shape,wcs = enmap.geometry(pos=np.deg2rad([[-1,-1],[1,1]]),shape=(n,n),proj='car')
+rng = np.random.default_rng(1)
+amat = rng.standard_normal((3*n*n,3*n*n))
+ucov = np.transpose((amat @ amat.T).reshape((3,n*n,3,n*n)),(0,2,1,3))
+alpha_pix = rng.uniform(-0.5,0.5,(2,n,n))
+dcov = lensing.lens_cov_pol((3,n,n),wcs,ucov,alpha_pix,sparse=True)
+for sparse in [False,True]:
+    rcov = lensing.lens_cov_pol((3,n,n),wcs,ucov,alpha_pix,comm=comm,sparse=sparse,distributed=True)
+    if comm.Get_rank()==0:
+        assert np.allclose(rcov,dcov,atol=1e-12*np.abs(dcov).max())
+    else:
+        assert rcov is None
+if comm.Get_rank()==0: open(sys.argv[1],"w").write(str(comm.Get_size()))
+''')
+    out = tmp_path / "out.txt"
+    mpi.run_local(str(script),4,args=(str(out),))
+    assert out.read_text()=="4"
+
+def test_incremental_delensing():
+    theory = get_theory()
+    shape,wcs = enmap.geometry(pos=np.deg2rad([[-5,-5],[5,5]]),shape=(200,200),proj='car')
+    nlgen = lensing.NlGenerator(shape,wcs,theory,bin_edges=np.arange(10,3000,40))
+    nlgen.updateNoise(1.,1.,1.4,100,3000,100,3000)
+    outs = [nlgen.getNlIterative(['TT','EE','TE','EB','TB'],100,3000,verbose=False,max_iterations=3,kappa_max=3000,
+                                 incremental=incremental,return_info=True) for incremental in [False,True]]
+    for i in [1,3,4]:
+        assert np.allclose(outs[1][i],outs[0][i],rtol=1e-8,equal_nan=True)
+    info = outs[1][5]
+    assert len(info['times'])==3 and len(info['bb_residuals'])==2
+    # both modes share the convergence criterion, so they stop at the same iteration
+    outs = [nlgen.getNlIterative(['TT','EE','TE','EB','TB'],100,3000,verbose=False,max_iterations=30,kappa_max=3000,
+                                 incremental=incremental,return_info=True)[5] for incremental in [False,True]]
+    assert len(outs[0]['times'])==len(outs[1]['times'])<30
+    assert np.allclose(outs[1]['bb_residuals'],outs[0]['bb_residuals'],rtol=1e-6)
+
+def test_projected_profile():
+    x = np.logspace(-3,1.5,500)
+    gtab = lensing.projected_profile(lensing.fnfw)(x)
+    assert np.allclose(gtab,2.*lensing.gnfw(x),rtol=1e-6)
+    M,c,R,comL = 2e14,3.2,1.2,2000.
+    thetas = np.linspace(0.1,10,20)*np.pi/180./60.
+    rho = lensing.rho_nfw(M,c,R)
+    brute = lensing.projected_rho(thetas,comL,rho,numps=500000)
+    assert np.allclose(lensing.projected_rho(thetas,comL,rho),brute,rtol=1e-4)
+    assert np.allclose(lensing.proj_rho_nfw(thetas,comL,M,c,R),brute,rtol=1e-4)
+    # members of the NFW family are served from the one untruncated fnfw table
+    for M,c in [(2e14,3.2),(5e14,4.)]:
+        sigma = lensing.projected_profile(lensing.rho_nfw(M,c,R))(thetas*comL)
+        assert np.allclose(sigma,lensing.proj_rho_nfw(thetas,comL,M,c,R),rtol=1e-6)
+    assert np.inf in lensing._projected_profiles[lensing.fnfw]
+    # projections that vanish or are negative fall back to direct quadrature
+    for f in [lambda r: np.where(r<3.,rho(r),0.),lambda r: -rho(r)]:
+        brute = lensing.projected_rho(thetas,comL,f,numps=500000)
+        sigma = lensing.projected_rho(thetas,comL,f)
+        assert np.all(np.isfinite(sigma))
+        assert np.allclose(sigma,brute,rtol=1e-2)
+
+class MockResults(object):
+    def comoving_radial_distance(self,z): return 3000.*np.asarray(z)/(1.+0.3*np.asarray(z))
+    def angular_diameter_distance(self,z): return self.comoving_radial_distance(z)/(1.+np.asarray(z))
+
+class MockCosmology(object):
+    h = 0.7
+    cmbZ = 1100.
+    results = MockResults()
+    def rdel_c(self,M,z,delta): return np.array([[0.5*(M/1e14)**(1./3.)/(1.+z)]])
+    def rdel_m(self,M,z,delta): return 0.6*(M/1e14)**(1./3.)/(1.+z)
+
+def test_nfw_sn_grid():
+    cc = MockCosmology()
+    ells = np.arange(2,20000,10.)
+    Nls = 1e-7*(1.+(ells/3000.)**2.)
+    lms = [14.,14.5,15.]
+    zs = [0.3,1.0]
+    # even (40x40) and odd (41x41) stamps, with and without the Rayleigh kernel
+    for arc in [20.,20.5]:
+        for ray in [None,1.]:
+            for nproc in [None,2]:
+                sn,k500,std = lensing.NFWMatchedFilterSNGrid(cc,lms,3.,zs,ells,Nls,8000.,arcStamp=arc,pxStamp=0.5,
+                                                             rayleighSigmaArcmin=ray,chunk_size=2,nproc=nproc)
+                for i,lm in enumerate(lms):
+                    for j,z in enumerate(zs):
+                        old = lensing.NFWMatchedFilterSN(cc,lm,3.,z,ells,Nls,8000.,arcStamp=arc,pxStamp=0.5,rayleighSigmaArcmin=ray)
+                        assert np.allclose([sn[i,j],k500[i,j],std[i,j]],old,rtol=1e-12,atol=0)
@@ -0,0 +1,192 @@
+import numpy as np
+from orphics import stats
+
+def test_bin2D_sparse():
+    modrmap = np.sqrt(np.add.outer(np.arange(-20,20)**2.,np.arange(-24,24)**2.))
+    bin_edges = np.arange(2,20,3)
+    data = np.random.standard_normal((2,3)+modrmap.shape)
+    dense = stats.bin2D(modrmap,bin_edges)
+    binner = stats.bin2D(modrmap,bin_edges,sparse=True)
+    cents,means,errs,counts = binner.bin(data,err=True,get_count=True)
+    assert means.shape==(2,3,bin_edges.size-1)
+    for i in range(cents.size):
+        sel = dense.digitized==i+1
+        pix = data.reshape((2,3,-1))[...,sel]
+        assert np.allclose(means[...,i],pix.mean(axis=-1))
+        assert np.allclose(errs[...,i],pix.std(axis=-1,ddof=1)/np.sqrt(sel.sum()))
+        assert np.all(counts[...,i]==sel.sum())
+    assert np.allclose(dense.bin(data[0,0],err=True)[2],errs[0,0])
+    weights = np.random.uniform(size=modrmap.shape)
+    assert np.allclose(binner.bin(data,weights=weights)[1][1,2],dense.bin(data[1,2],weights=weights)[1])
+    # no pixel lies beyond the last edge; both paths still return every bin
+    bin_edges = np.arange(0.5,40,5)
+    dense = stats.bin2D(modrmap,bin_edges)
+    binner = stats.bin2D(modrmap,bin_edges,sparse=True)
+    assert np.all(dense.digitized<=bin_edges.size-1)
+    for w in [None,weights]:
+        ret = dense.bin(data[0,0],weights=w,get_count=True)
+        sret = binner.bin(data[0,0],weights=w,get_count=True)
+        assert ret[1].shape==sret[1].shape==ret[2].shape==(bin_edges.size-1,)
+        assert np.allclose(ret[1],sret[1],equal_nan=True) and np.allclose(ret[2],sret[2])
+    assert dense.bin(data[0,0],err=True)[2].shape==(bin_edges.size-1,)
+
+def test_streaming_stats():
+    from orphics import mpi
+    data = np.random.standard_normal((200,6))*np.arange(1,7)+1e4
+    full = stats.Stats(mpi.MPI.COMM_WORLD)
+    stream = stats.Stats(mpi.MPI.COMM_WORLD,streaming=True)
+    for x in data:
+        full.add_to_stats("a",x)
+        stream.add_to_stats("a",x)
+    stream.add_to_stats("empty",np.zeros(3),exclude=True)
+    assert stream.vectors["a"]==[]
+    full.get_stats(verbose=False)
+    stream.get_stats()
+    assert stream.numobj["a"]==200 and stream.numobj["empty"]==0
+    for key in ['mean','cov','covmean','err','errmean','corr']:
+        assert np.allclose(stream.stats["a"][key],full.stats["a"][key],rtol=1e-8,atol=0)
+    # the collective merge of packed moments
+    counts,means,m2s = stream._reduce_moments()
+    assert counts["a"]==200 and np.allclose(means["a"],data.mean(axis=0))
+    assert np.allclose(m2s["a"]/199.,np.cov(data.T))
+
+def test_get_stacks():
+    from orphics import mpi
+    st = stats.Stats(mpi.MPI.COMM_WORLD)
+    arrs = np.random.standard_normal((5,4,6))
+    for arr in arrs: st.add_to_stack("a",arr)
+    st.add_to_stack("b",np.ones(3))
+    st.get_stacks(verbose=False)
+    assert st.stack_count=={"a":5,"b":1}
+    assert np.allclose(st.stacks["a"],arrs.mean(axis=0)) and np.allclose(st.stacks["b"],1.)
+    assert np.allclose(st.little_stack["a"],arrs.sum(axis=0))
+
+def test_stats_checkpoint(tmp_path):
+    prefix = str(tmp_path/"run")
+    data = np.random.standard_normal((10,4))
+    for streaming in [False,True]:
+        ref = stats.Stats(streaming=streaming)
+        for x in data:
+            ref.add_to_stats("v",x)
+            ref.add_to_stack("s",np.outer(x,x))
+        # a run that dies after 6 tasks, checkpointing every 2
+        first = stats.Stats(streaming=streaming,checkpoint=prefix+str(streaming),checkpoint_every=2)
+        assert first.resume(range(10))==list(range(10))
+        for task in range(7):
+            first.add_to_stats("v",data[task])
+            first.add_to_stack("s",np.outer(data[task],data[task]))
+            if task<6: first.task_done(task)
+        second = stats.Stats(streaming=streaming,checkpoint=prefix+str(streaming),checkpoint_every=2)
+        remaining = second.resume(range(10))
+        assert remaining==list(range(6,10))
+        for task in remaining:
+            second.add_to_stats("v",data[task])
+            second.add_to_stack("s",np.outer(data[task],data[task]))
+            second.task_done(task)
+        for st in [ref,second]:
+            st.get_stats(verbose=False)
+            st.get_stacks(verbose=False)
+        assert second.stack_count["s"]==10 and np.allclose(second.stacks["s"],ref.stacks["s"])
+        for key in ['mean','cov']:
+            assert np.allclose(second.stats["v"][key],ref.stats["v"][key])
+
+def test_stats_checkpoint_interrupted_merge(tmp_path):
+    import shutil
+    from orphics import mpi
+    class RankComm(mpi.fakeMpiComm):
+        def __init__(self,rank): self.rank = rank
+        def Get_rank(self): return self.rank
+        def Get_size(self): return 3
+    prefix = str(tmp_path/"run")
+    data = np.random.standard_normal((9,4))
+    # a 3-rank run, each rank done with 3 tasks
+    for rank in range(3):
+        st = stats.Stats(RankComm(rank),streaming=True,checkpoint=prefix)
+        for task in range(rank*3,rank*3+3):
+            st.add_to_stats("v",data[task])
+            st.task_done(task)
+    # resumed on one rank, which crashes after writing the merged file but
+    # before removing the files it absorbed
+    for rank in [1,2]: shutil.copy("%s_rank%d.npz" % (prefix,rank),str(tmp_path/("copy%d" % rank)))
+    assert stats.Stats(streaming=True,checkpoint=prefix).resume(range(9))==[]
+    for rank in [1,2]: shutil.copy(str(tmp_path/("copy%d" % rank)),"%s_rank%d.npz" % (prefix,rank))
+    st = stats.Stats(streaming=True,checkpoint=prefix)
+    assert st.resume(range(9))==[]
+    assert sorted(st.done)==list(range(9))
+    assert st.counts["v"]==9 and np.allclose(st.means["v"],data.mean(axis=0))
+    assert len(list(tmp_path.glob("run_rank*.npz")))==1
+
+def test_dynamic_distribute():
+    from orphics import mpi
+    comm,rank,my_tasks = mpi.dynamic_distribute([3,5,7,11,13],chunk_size=2,verbose=False)
+    assert list(my_tasks)==[3,5,7,11,13]
+    ret = my_tasks.report(verbose=False)
+    assert ret['ntasks'][0]==5
+    assert 0<=ret['utilization'][0]<=1
+    my_tasks = mpi.DynamicTasks(4,comm=mpi.fakeMpiComm())
+    assert list(my_tasks)==[0,1,2,3]
+
+def test_run_local(tmp_path):
+    # Stats reductions and dynamic scheduling across local processes
+    from orphics import mpi
+    script = tmp_path / "job.py"
+    script.write_text('''
+import sys
+import numpy as np
+from orphics import mpi, stats
+comm = mpi.MPI.COMM_WORLD
+st = stats.Stats(comm,streaming=True)
+tasks = []
+for i in mpi.DynamicTasks(10,comm=comm,chunk_size=2):
+    st.add_to_stats("v",np.arange(3.)+i)
+    st.add_to_stack("s",np.ones((2,2))*i)
+    tasks.append(i)
+st.get_stats()
+st.get_stacks(verbose=False)
+tasks = comm.allgather(tasks)
+if comm.Get_rank()==0:
+    np.savez(sys.argv[1],mean=st.stats["v"]["mean"],stack=st.stacks["s"],tasks=sorted(sum(tasks,[])),size=comm.Get_size())
+''')
+    out = str(tmp_path / "out.npz")
+    assert mpi.run_local(str(script),3,args=(out,))==[None]*3
+    d = np.load(out)
+    assert d['size']==3
+    assert np.allclose(d['mean'],np.arange(3.)+4.5)
+    assert np.allclose(d['stack'],4.5)
+    assert np.all(d['tasks']==np.arange(10))
+
+def test_dynamic_tasks_early_stop(tmp_path):
+    # A rank leaving the loop early must not hang the others on close
+    import os, subprocess, shutil, sys
+    from orphics import mpi
+    script = tmp_path / "job.py"
+    script.write_text('''
+import sys
+import numpy as np
+from orphics import mpi
+comm = mpi.MPI.COMM_WORLD
+my_tasks = mpi.DynamicTasks(12,comm=comm)
+tasks = []
+for i in my_tasks:
+    tasks.append(i)
+    if comm.Get_rank()==1: break
+my_tasks.report(verbose=False)
+my_tasks.close()
+tasks = comm.allgather(tasks)
+if comm.Get_rank()==0:
+    np.save(sys.argv[1],sorted(sum(tasks,[])))
+''')
+    out = str(tmp_path / "out.npy")
+    mpi.run_local(str(script),3,args=(out,))
+    assert np.all(np.load(out)==np.arange(12))
+    mpiexec = shutil.which("mpiexec") or shutil.which("mpiexec",path=os.path.join(sys.prefix,"bin"))
+    try:
+        import mpi4py
+    except ImportError:
+        mpiexec = None
+    if mpiexec is None: return
+    os.remove(out)
+    env = dict(os.environ,PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(mpi.__file__))))
+    env.pop("DISABLE_MPI",None)
+    subprocess.run([mpiexec,"-n","2",sys.executable,str(script),out],env=env,check=True,timeout=120)
+    assert np.all(np.load(out)==np.arange(12))